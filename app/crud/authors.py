@@ -3,6 +3,7 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.crud.crud_interface import CrudInterface
+from app.crud.index_jobs import IndexMetadataJobsCrud
 from app.models import author_table
 from app.schemas import AuthorCreate
 from app.utils import CrudException
@@ -60,6 +61,8 @@ class AuthorsCrud(CrudInterface):
             if author_in_db is not None:
                 query = update(author_table).where(author_table.c.id == author_id).values(**author.model_dump())
                 await session.execute(query)
+                if author_in_db['name'] != author.name:
+                    await IndexMetadataJobsCrud.enqueue(session, "author_id", [author_id])
                 author_in_db = await cls.get(session, author_id)
             return author_in_db
         except IntegrityError as e:
@@ -1,41 +1,100 @@
-import urllib.parse
+import base64, json, math, urllib.parse
 from datetime import date
-from sqlalchemy import select, insert, update, delete
+from fastapi import HTTPException
+from sqlalchemy import select, insert, update, delete, any_, bindparam, tuple_, or_, func, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.crud.authors import AuthorsCrud
 from app.crud.crud_interface import CrudInterface
 from app.crud.genres import GenresCrud
+from app.crud.index_jobs import IndexJobsCrud, IndexMetadataJobsCrud
 from app.crud.indexing import Indexing
 from app.crud.storage import Storage
-from app.models import book_table
-from app.schemas import BookCreate, GenreCreate, AuthorCreate
+from app.models import book_table, book_sort_keys, genre_table, author_table
+from app.schemas import BookCreate, GenreCreate, AuthorCreate, BooksSortEnum, SortOrderEnum
 from app.schemas.books import BookUpdate
 
 
 class BooksCrud(CrudInterface):
+    ## поля book_table, копии которых хранятся в поисковом индексе
+    INDEXED_FIELDS = ['title', 'author', 'genre', 'published_date', 'avg_mark', 'theme_id']
+
     @classmethod
     async def get(cls, session: AsyncSession, element_id: int):
         query = select(book_table).where(book_table.c.id == element_id)
         result = await session.execute(query)
         return result.mappings().first()
 
+    @classmethod
+    async def get_batch(cls, session: AsyncSession, element_ids: list[int]):
+        """Returns books in order of `element_ids`, missing ones are skipped"""
+        ids = list(dict.fromkeys(element_ids))
+        query = select(book_table).where(book_table.c.id == any_(bindparam("ids", ids, type_=ARRAY(Integer))))
+        result = await session.execute(query)
+        books = {book['id']: book for book in result.mappings().all()}
+        return [books[book_id] for book_id in ids if book_id in books]
+
+    @classmethod
+    def __encode_cursor(cls, sort: BooksSortEnum, order: SortOrderEnum, sort_value, book_id: int) -> str:
+        raw = json.dumps([sort.value, order.value, sort_value, book_id])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @classmethod
+    def __decode_cursor(cls, cursor: str, sort: BooksSortEnum, order: SortOrderEnum):
+        try:
+            cursor_sort, cursor_order, sort_value, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise ValueError("Invalid cursor")
+        if cursor_sort != sort.value or cursor_order != order.value:
+            raise ValueError("Cursor was issued for another sort order")
+        if not cls.__is_sort_value(sort, sort_value) or not cls.__is_integer(book_id):
+            raise ValueError("Invalid cursor")
+        return sort_value, book_id
+
+    @classmethod
+    def __is_integer(cls, value) -> bool:
+        ## Integer колонки PostgreSQL 4-байтные
+        return type(value) is int and -2 ** 31 <= value < 2 ** 31
+
+    @classmethod
+    def __is_sort_value(cls, sort: BooksSortEnum, value) -> bool:
+        """Checks that the cursor value can be compared with the sort key, keys are coalesced so never null"""
+        if sort == BooksSortEnum.TITLE:
+            return isinstance(value, str)
+        if sort == BooksSortEnum.AVG_MARK:
+            return type(value) in (int, float) and math.isfinite(value)
+        return cls.__is_integer(value)
+
     @classmethod
     async def get_multiple(cls, session: AsyncSession, title=None, author=None, genre=None, published_date=None,
-                           description=None, min_mark=None, max_mark=None):
-        query = select(book_table.c.id)
+                           description=None, min_mark=None, max_mark=None, sort: BooksSortEnum = BooksSortEnum.ID,
+                           order: SortOrderEnum = SortOrderEnum.ASC, limit: int = 50, cursor: str | None = None):
+        """Returns page of books ids and cursor of the next page (None for the last one)"""
+        sort_key = book_sort_keys[sort.value]
+        query = select(book_table.c.id, sort_key.label("sort_value"))
+        if cursor:
+            sort_value, book_id = cls.__decode_cursor(cursor, sort, order)
+            position = tuple_(sort_key, book_table.c.id)
+            query = query.where(position > tuple_(sort_value, book_id) if order == SortOrderEnum.ASC
+                                else position < tuple_(sort_value, book_id))
+        if order == SortOrderEnum.ASC:
+            query = query.order_by(sort_key.asc(), book_table.c.id.asc())
+        else:
+            query = query.order_by(sort_key.desc(), book_table.c.id.desc())
+        query = query.limit(limit + 1)
         if title:
             query = query.where(book_table.c.title.ilike(f"%{title}%"))
         if author:
             author_in_db = await AuthorsCrud.get_multiple(session, author)
             if not author_in_db:
-                return []
+                return [], None
             author_id = author_in_db[0].get("id")
             query = query.where(book_table.c.author == author_id)
         if genre:
             genre_in_db = await GenresCrud.get_multiple(session, genre)
             if not genre_in_db:
-                return []
+                return [], None
             genre_id = genre_in_db[0].get("id")
             query = query.where(book_table.c.genre == genre_id)
         if published_date:
@@ -49,7 +108,35 @@ class BooksCrud(CrudInterface):
 
         result = await session.execute(query)
         books = result.mappings().all()
-        return [book['id'] for book in books]
+        next_cursor = None
+        if len(books) > limit:
+            books = books[:limit]
+            next_cursor = cls.__encode_cursor(sort, order, books[-1]['sort_value'], books[-1]['id'])
+        return [book['id'] for book in books], next_cursor
+
+    @classmethod
+    def __indexing_query(cls):
+        """Fields needed for indexing: PDF and book metadata copied into search documents"""
+        return (
+            select(book_table.c.id, book_table.c.pdf_qname, book_table.c.title, book_table.c.theme_id,
+                   book_table.c.published_date, book_table.c.avg_mark,
+                   author_table.c.id.label("author_id"), author_table.c.name.label("author"),
+                   genre_table.c.id.label("genre_id"), genre_table.c.name.label("genre"))
+            .join(author_table, book_table.c.author == author_table.c.id)
+            .outerjoin(genre_table, book_table.c.genre == genre_table.c.id)
+        )
+
+    @classmethod
+    async def get_for_indexing(cls, session: AsyncSession, element_id: int):
+        result = await session.execute(cls.__indexing_query().where(book_table.c.id == element_id))
+        return result.mappings().first()
+
+    @classmethod
+    async def get_indexing_batch(cls, session: AsyncSession, after_id: int, limit: int):
+        """Books with id greater than `after_id` in id order, with fields needed for indexing"""
+        query = cls.__indexing_query().where(book_table.c.id > after_id).order_by(book_table.c.id).limit(limit)
+        result = await session.execute(query)
+        return result.mappings().all()
 
     @classmethod
     async def create(cls, session: AsyncSession, model: BookCreate):
@@ -63,9 +150,51 @@ class BooksCrud(CrudInterface):
         author_id = await AuthorsCrud.get_existent_or_create(session, author_creation_model)
         book_dict['author'] = author_id
 
+        await cls.__reference_file(session, book_dict['pdf_qname'])
+        await cls.__reference_file(session, book_dict['image_qname'])
         query = insert(book_table).values(**book_dict)
         result = await session.execute(query)
-        return result.inserted_primary_key[0]
+        book_id = result.inserted_primary_key[0]
+        await IndexJobsCrud.enqueue(session, book_id)
+        return book_id
+
+    @classmethod
+    async def __lock_file(cls, session: AsyncSession, qname: str):
+        ## до конца транзакции: удаление объекта и появление новой ссылки на него не пересекаются
+        await session.execute(select(func.pg_advisory_xact_lock(func.hashtext(qname))))
+
+    @classmethod
+    async def __reference_file(cls, session: AsyncSession, qname: str | None):
+        """Checks that the uploaded object still exists before a book refers to it: a deduplicated upload returns
+        the name of an existing object, which may be deleted with the last book referring to it meanwhile"""
+        if not qname:
+            return
+        await cls.__lock_file(session, qname)
+        if not await Storage.is_file_exists(urllib.parse.unquote(qname)):
+            raise HTTPException(status_code=409, detail=f"File {qname} was deleted, upload it again")
+
+    @classmethod
+    async def delete_file_if_unreferenced(cls, session: AsyncSession, qname: str) -> bool:
+        """Identical uploads share one object, so it is deleted only if no book refers to it. Returns whether
+        the object was deleted"""
+        await cls.__lock_file(session, qname)
+        query = select(book_table.c.id).where(
+            or_(book_table.c.pdf_qname == qname, book_table.c.image_qname == qname)
+        ).limit(1)
+        if (await session.execute(query)).first() is not None:
+            return False
+        await Storage.delete_file_in_s3(urllib.parse.unquote(qname))
+        return True
+
+    @classmethod
+    async def __delete_unreferenced_file(cls, session: AsyncSession, qname: str | None):
+        if qname:
+            await cls.delete_file_if_unreferenced(session, qname)
+
+    @classmethod
+    async def sync_index_fields(cls, session: AsyncSession, element_ids: list[int]):
+        """Queues copying of the metadata of books into their indexed pages after commit of the session"""
+        await IndexMetadataJobsCrud.enqueue(session, "book_id", element_ids)
 
     @classmethod
     async def delete(cls, session: AsyncSession, element_id: int):
@@ -74,9 +203,8 @@ class BooksCrud(CrudInterface):
             query = delete(book_table).where(book_table.c.id == element_id)
             await session.execute(query)
             await Indexing.delete_book(element_id)
-            Storage.delete_file_in_s3(urllib.parse.unquote(book['pdf_qname']))
-            if book['image_qname'] is not None and book['image_qname'] != "":
-                Storage.delete_file_in_s3(urllib.parse.unquote(book['image_qname']))
+            await cls.__delete_unreferenced_file(session, book['pdf_qname'])
+            await cls.__delete_unreferenced_file(session, book['image_qname'])
         return book
 
     @classmethod
@@ -86,14 +214,18 @@ class BooksCrud(CrudInterface):
             return None
 
         book_dict = model.model_dump()
-        if book_dict['pdf_qname'] and book_dict['pdf_qname'] != book_in_db['pdf_qname']:
+        replaced_files = []
+        reindex = bool(book_dict['pdf_qname']) and book_dict['pdf_qname'] != book_in_db['pdf_qname']
+        if reindex:
+            await cls.__reference_file(session, book_dict['pdf_qname'])
             await Indexing.delete_book(element_id)
-            Storage.delete_file_in_s3(urllib.parse.unquote(book_in_db['pdf_qname']))
-            await Indexing.index_book(element_id, book_dict['genre'], urllib.parse.unquote(book_dict['pdf_qname']))
+            replaced_files.append(book_in_db['pdf_qname'])
+            await IndexJobsCrud.enqueue(session, element_id)
 
         if book_dict['image_qname'] and book_dict['image_qname'] != "" and book_dict['image_qname'] != book_in_db[
             'image_qname']:
-            Storage.delete_file_in_s3(urllib.parse.unquote(book_in_db['image_qname']))
+            await cls.__reference_file(session, book_dict['image_qname'])
+            replaced_files.append(book_in_db['image_qname'])
 
         if book_dict['genre']:
             genre_creation_model = GenreCreate(name=book_dict['genre'])
@@ -111,4 +243,8 @@ class BooksCrud(CrudInterface):
 
         query = update(book_table).where(book_table.c.id == element_id).values(**book_dict)
         await session.execute(query)
+        if not reindex and any(book_dict[key] != book_in_db[key] for key in cls.INDEXED_FIELDS):
+            await cls.sync_index_fields(session, [element_id])
+        for qname in replaced_files:
+            await cls.__delete_unreferenced_file(session, qname)
         return await cls.get(session, element_id)
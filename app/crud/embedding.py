@@ -0,0 +1,125 @@
+import asyncio, hashlib, math, re, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.settings.embedding import embedding_cred
+
+__all__ = ["Embedding", "HashingEmbedder", "TransformerEmbedder", "chunk_text"]
+
+_TOKEN = re.compile(r"\w+")
+
+
+def chunk_text(text: str, chunk_words: int = embedding_cred.chunk_words,
+               overlap: int = embedding_cred.chunk_overlap) -> list[str]:
+    """Splits text into chunks of `chunk_words` words, neighbouring chunks share `overlap` words"""
+    words = text.split()
+    step = max(chunk_words - overlap, 1)
+    return [" ".join(words[start:start + chunk_words]) for start in range(0, max(len(words) - overlap, 1), step)
+            if words[start:start + chunk_words]]
+
+
+class HashingEmbedder:
+    """Deterministic stand-in model without weights: signed hashing of words into `dims` buckets"""
+
+    def __init__(self, dims: int):
+        self.dims = dims
+
+    def encode(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for text in texts:
+            vector = [0.0] * self.dims
+            for token in _TOKEN.findall(text.lower()):
+                digest = int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "little")
+                vector[digest % self.dims] += 1.0 if digest >> 63 else -1.0
+            norm = math.sqrt(sum(value * value for value in vector))
+            ## нулевой вектор недопустим для косинусной близости
+            vectors.append([value / norm for value in vector] if norm else [1.0 / math.sqrt(self.dims)] * self.dims)
+        return vectors
+
+
+class TransformerEmbedder:
+    """Local transformers model with mean pooling, torch and transformers are imported on first use"""
+
+    def __init__(self, path: str, max_length: int, threads: int):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.__torch = torch
+        self.__tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+        self.__model = AutoModel.from_pretrained(path, local_files_only=True).eval()
+        self.__max_length = max_length
+        self.dims = self.__model.config.hidden_size
+
+    def encode(self, texts: list[str]) -> list[list[float]]:
+        torch = self.__torch
+        batch = self.__tokenizer(texts, padding=True, truncation=True, max_length=self.__max_length,
+                                 return_tensors="pt")
+        with torch.inference_mode():
+            hidden = self.__model(**batch).last_hidden_state
+        mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return torch.nn.functional.normalize(pooled, dim=1).tolist()
+
+
+class Embedding:
+    ## модель сама использует все ядра, поэтому батчи книг считаются последовательно в одном потоке;
+    ## запросы поиска считаются в отдельном потоке и не ждут в очереди за целыми книгами
+    __executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+    __query_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-query")
+    __model: HashingEmbedder | TransformerEmbedder | None = None
+    __model_lock = threading.Lock()
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return embedding_cred.enabled
+
+    @classmethod
+    def get_model(cls) -> HashingEmbedder | TransformerEmbedder:
+        with cls.__model_lock:  ## первый вызов возможен одновременно из потоков книг и запросов
+            if cls.__model is None:
+                if embedding_cred.model == "hashing":
+                    model = HashingEmbedder(embedding_cred.dims)
+                else:
+                    model = TransformerEmbedder(embedding_cred.model, embedding_cred.max_length,
+                                                embedding_cred.threads)
+                if model.dims != embedding_cred.dims:
+                    raise ValueError(f"Model produces {model.dims}-dimensional vectors, "
+                                     f"EMBEDDING_DIMS is {embedding_cred.dims}")
+                cls.__model = model
+            return cls.__model
+
+    @classmethod
+    def encode(cls, texts: list[str], batch_size: int = embedding_cred.batch_size) -> list[list[float]]:
+        model = cls.get_model()
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            vectors.extend(model.encode(texts[start:start + batch_size]))
+        return vectors
+
+    @classmethod
+    async def embed(cls, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return await asyncio.get_running_loop().run_in_executor(cls.__executor, cls.encode, texts)
+
+    @classmethod
+    async def embed_query(cls, query: str) -> list[float]:
+        """Vector of a search query, encoded next to running book batches (inference doesn't change the model)"""
+        return (await asyncio.get_running_loop().run_in_executor(cls.__query_executor, cls.encode, [query]))[0]
+
+    @classmethod
+    async def embed_pages(cls, pages: list[tuple[int, str]]) -> dict[int, list[list[float]]]:
+        """Vectors of chunks of every page, all chunks of the book are encoded in shared batches"""
+        chunks = [(page, chunk) for page, content in pages for chunk in chunk_text(content)]
+        vectors = await cls.embed([chunk for _, chunk in chunks])
+        page_vectors: dict[int, list[list[float]]] = {}
+        for (page, _), vector in zip(chunks, vectors):
+            page_vectors.setdefault(page, []).append(vector)
+        return page_vectors
+
+    @classmethod
+    def shutdown(cls):
+        cls.__executor.shutdown(wait=False, cancel_futures=True)
+        cls.__query_executor.shutdown(wait=False, cancel_futures=True)
+
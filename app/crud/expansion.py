@@ -0,0 +1,118 @@
+import mmap, os, sys
+from functools import lru_cache
+
+from app.settings.indexing import indexing_cred
+
+__all__ = ["expand_words", "build_expansion_table", "english_stop_words", "nltk_corpus"]
+
+## правила отсечения окончаний WordNet (morphy), объединенные для всех частей речи
+_SUFFIX_SUBSTITUTIONS = [
+    ('s', ''), ('ses', 's'), ('ves', 'f'), ('xes', 'x'), ('zes', 'z'), ('ches', 'ch'), ('shes', 'sh'),
+    ('men', 'man'), ('ies', 'y'), ('es', 'e'), ('es', ''), ('ed', 'e'), ('ed', ''), ('ing', 'e'), ('ing', ''),
+    ('er', ''), ('est', ''), ('er', 'e'), ('est', 'e')
+]
+
+
+def nltk_corpus(name: str):
+    """Corpus from the local data dir, nltk is imported on first use and never downloads anything"""
+    import nltk
+
+    if indexing_cred.nltk_data_path not in nltk.data.path:
+        nltk.data.path.insert(0, indexing_cred.nltk_data_path)
+    return getattr(nltk.corpus, name)
+
+
+@lru_cache(maxsize=1)
+def english_stop_words() -> frozenset[str]:
+    return frozenset(nltk_corpus("stopwords").words('english'))
+
+
+class _ExpansionTable:
+    """Sorted `term<TAB>expansion|expansion...` lines, looked up by binary search over a memory-mapped file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, term: str) -> list[str] | None:
+        key = term.encode()
+        low, high = 0, len(self.__map)
+        while low < high:
+            middle = (low + high) // 2
+            start = self.__map.rfind(b"\n", 0, middle) + 1
+            end = self.__map.find(b"\n", start)
+            if end == -1:
+                end = len(self.__map)
+            line_key, _, expansions = self.__map[start:end].partition(b"\t")
+            if line_key == key:
+                return expansions.decode().split("|") if expansions else []
+            if line_key < key:
+                low = end + 1
+            else:
+                high = start
+        return None
+
+
+def _wordnet_expansions(word: str) -> set[str]:
+    wordnet = nltk_corpus("wordnet")
+    related_terms = set()
+    for synset in wordnet.synsets(word):
+        for lemma in synset.lemmas():
+            related_terms.add(lemma.name().replace('_', ' '))
+        for hypernym in synset.hypernyms():
+            for hypernym_term in hypernym.lemma_names():
+                related_terms.add(hypernym_term.replace('_', ' '))
+    return related_terms
+
+
+@lru_cache(maxsize=1)
+def _load_table() -> _ExpansionTable | None:
+    if not os.path.exists(indexing_cred.expansions_path):
+        print(f"BOOK-PROCESSING: {indexing_cred.expansions_path} not found, expanding queries with WordNet directly")
+        return None
+    return _ExpansionTable(indexing_cred.expansions_path)
+
+
+def _expand_word(word: str) -> set[str]:
+    table = _load_table()
+    if table is None:
+        return _wordnet_expansions(word)
+    expansions = table.get(word)
+    if expansions is not None:
+        return set(expansions)
+    related_terms = set()
+    for old, new in _SUFFIX_SUBSTITUTIONS:
+        if word.endswith(old):
+            related_terms.update(table.get(word[:-len(old)] + new) or [])
+    return related_terms
+
+
+@lru_cache(maxsize=indexing_cred.expansion_cache_size)
+def expand_words(words: tuple[str, ...]) -> str:
+    """Query words joined with their WordNet synonyms and hypernyms. Pass words sorted to share cache entries"""
+    related_terms = set(words)
+    for word in words:
+        related_terms.update(_expand_word(word))
+    return " ".join(sorted(related_terms))
+
+
+def build_expansion_table(path: str):
+    wordnet = nltk_corpus("wordnet")
+    terms = {name.lower() for name in wordnet.all_lemma_names() if '_' not in name}
+    for pos in "nvar":
+        terms.update(form for form in wordnet._exception_map[pos] if '_' not in form)
+    lines = []
+    for term in terms:
+        if '\t' in term or '\n' in term:
+            continue
+        lines.append((term.encode(), "|".join(sorted(_wordnet_expansions(term))).encode()))
+    lines.sort()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(b"\n".join(term + b"\t" + expansions for term, expansions in lines))
+    print(f"Written {len(lines)} terms to {path}")
+
+
+## сборка таблицы: python -m app.crud.expansion [path]
+if __name__ == "__main__":
+    build_expansion_table(sys.argv[1] if len(sys.argv) > 1 else indexing_cred.expansions_path)
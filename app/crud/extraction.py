@@ -0,0 +1,46 @@
+import re
+from typing import Iterator
+
+__all__ = ["pdf_pages", "send_pdf_pages", "iter_pdf_pages", "preprocess_text"]
+
+
+def preprocess_text(text: str, remove_punctuation: bool = True) -> str:
+    text = text.replace("\n", " ").replace("\t", " ")
+    text = re.sub(r'\s+', ' ', text)  ## лишние пробелы
+
+    if remove_punctuation:
+        text = re.sub(r'[^\w\s]', '', text)
+
+    text = text.lower()
+    return text.strip()
+
+
+def iter_pdf_pages(path: str) -> Iterator[str]:
+    import pdfplumber  ## тяжелый импорт нужен только процессам извлечения текста
+
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text() or ""
+            page.close()  ## сбрасываем кэш разметки страницы, чтобы память не росла с размером книги
+            yield text
+
+
+def pdf_pages(path: str) -> Iterator[tuple[int, str]]:
+    """Normalized text of every non-empty page with its number, starting from 1"""
+    for number, text in enumerate(iter_pdf_pages(path), start=1):
+        if text := preprocess_text(text):
+            yield number, text
+
+
+# Target of the extraction process started for every document, so it must stay a picklable module-level function
+def send_pdf_pages(connection, path: str):
+    """Sends pages of `pdf_pages` one by one as (number, text), then None. An error is sent as its message.
+    The pipe buffer is small, so the process waits for the reader and holds only the current page"""
+    try:
+        for page in pdf_pages(path):
+            connection.send(page)
+        connection.send(None)
+    except Exception as e:
+        connection.send(f"{type(e).__name__}: {e}")
+    finally:
+        connection.close()
@@ -3,6 +3,7 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.crud.crud_interface import CrudInterface
+from app.crud.index_jobs import IndexMetadataJobsCrud
 from app.models import genre_table
 from app.schemas import GenreCreate
 from app.utils import CrudException
@@ -60,6 +61,8 @@ class GenresCrud(CrudInterface):
             if genre_in_db is not None:
                 query = update(genre_table).where(genre_table.c.id == genre_id).values(**genre.model_dump())
                 await session.execute(query)
+                if genre_in_db['name'] != genre.name:
+                    await IndexMetadataJobsCrud.enqueue(session, "genre_id", [genre_id])
                 genre_in_db = await cls.get(session, genre_id)
             return genre_in_db
         except IntegrityError as e:
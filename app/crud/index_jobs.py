@@ -0,0 +1,167 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, update, delete, and_, or_, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import index_job_table, index_metadata_job_table
+from app.schemas import IndexJob, IndexJobStatusEnum
+from app.settings.indexing import indexing_cred
+
+
+class IndexJobsCrud:
+    JOB_FIELDS = ['id', 'book_id', 'status', 'attempts', 'last_error', 'run_after', 'updated_at']
+
+    @classmethod
+    async def get_by_book(cls, session: AsyncSession, book_id: int) -> Optional[IndexJob]:
+        result = (await session.execute(
+            select(*[index_job_table.c[field] for field in cls.JOB_FIELDS])
+            .where(index_job_table.c.book_id == book_id)
+        )).mappings().first()
+        return None if result is None else IndexJob(**result)
+
+    @classmethod
+    async def enqueue(cls, session: AsyncSession, book_id: int):
+        job_state = {
+            'status': IndexJobStatusEnum.PENDING.value,
+            'attempts': 0,
+            'last_error': None,
+            'run_after': func.now(),
+            'locked_until': None,
+            'updated_at': func.now()
+        }
+        query = insert(index_job_table).values(book_id=book_id, **job_state)
+        await session.execute(query.on_conflict_do_update(index_elements=[index_job_table.c.book_id], set_=job_state))
+
+    @classmethod
+    async def claim(cls, session: AsyncSession):
+        """Locks the next due job for this worker. Running jobs with an expired lease belong to dead workers.
+
+        `locked_until` of the claimed job identifies this run, `complete` and `fail` take effect only while
+        the job is still held by it (not requeued or reclaimed meanwhile).
+        """
+        next_job = (
+            select(index_job_table.c.id)
+            .where(or_(
+                and_(index_job_table.c.status == IndexJobStatusEnum.PENDING.value,
+                     index_job_table.c.run_after <= func.now()),
+                and_(index_job_table.c.status == IndexJobStatusEnum.RUNNING.value,
+                     index_job_table.c.locked_until < func.now())
+            ))
+            .order_by(index_job_table.c.run_after)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        result = await session.execute(
+            update(index_job_table)
+            .where(index_job_table.c.id == next_job)
+            .values(status=IndexJobStatusEnum.RUNNING.value,
+                    attempts=index_job_table.c.attempts + 1,
+                    locked_until=func.now() + timedelta(seconds=indexing_cred.job_lease),
+                    updated_at=func.now())
+            .returning(index_job_table.c.id, index_job_table.c.book_id, index_job_table.c.attempts,
+                       index_job_table.c.locked_until)
+        )
+        return result.mappings().first()
+
+    @classmethod
+    def __held_by(cls, job_id: int, locked_until: datetime):
+        return and_(index_job_table.c.id == job_id,
+                    index_job_table.c.status == IndexJobStatusEnum.RUNNING.value,
+                    index_job_table.c.locked_until == locked_until)
+
+    @classmethod
+    async def complete(cls, session: AsyncSession, job_id: int, locked_until: datetime) -> bool:
+        """False if the job is no longer held by this run: requeued, reclaimed or deleted with its book"""
+        result = await session.execute(
+            update(index_job_table)
+            .where(cls.__held_by(job_id, locked_until))
+            .values(status=IndexJobStatusEnum.DONE.value, last_error=None, locked_until=None, updated_at=func.now())
+        )
+        return result.rowcount > 0
+
+    @classmethod
+    async def fail(cls, session: AsyncSession, job_id: int, locked_until: datetime, attempts: int, error: str):
+        if attempts >= indexing_cred.job_max_attempts:
+            job_state = {'status': IndexJobStatusEnum.FAILED.value}
+        else:
+            job_state = {
+                'status': IndexJobStatusEnum.PENDING.value,
+                'run_after': func.now() + timedelta(seconds=indexing_cred.job_backoff(attempts))
+            }
+        await session.execute(
+            update(index_job_table)
+            .where(cls.__held_by(job_id, locked_until))
+            .values(last_error=error, locked_until=None, updated_at=func.now(), **job_state)
+        )
+
+    @classmethod
+    async def requeue_completed_since(cls, session: AsyncSession, since: datetime) -> int:
+        """Queues again books indexed after `since`, their pages went to the index the alias pointed to then"""
+        result = await session.execute(
+            update(index_job_table)
+            .where(index_job_table.c.status == IndexJobStatusEnum.DONE.value, index_job_table.c.updated_at >= since)
+            .values(status=IndexJobStatusEnum.PENDING.value, attempts=0, run_after=func.now(), updated_at=func.now())
+        )
+        return result.rowcount
+
+
+class IndexMetadataJobsCrud:
+    """Queue of metadata updates of indexed pages (`Indexing.update_metadata`). Jobs are queued in the transaction
+    changing the database and applied after its commit, current values are read when the job runs, so one job per
+    (`field`, `value`) is enough and it is retried until Elasticsearch accepts it"""
+
+    @classmethod
+    async def enqueue(cls, session: AsyncSession, field: str, values: list[int]):
+        if not values:
+            return
+        job_state = {'attempts': 0, 'last_error': None, 'run_after': func.now(), 'locked_until': None}
+        query = insert(index_metadata_job_table).values([{'field': field, 'value': value, **job_state}
+                                                         for value in sorted(set(values))])
+        await session.execute(query.on_conflict_do_update(
+            index_elements=[index_metadata_job_table.c.field, index_metadata_job_table.c.value], set_=job_state
+        ))
+
+    @classmethod
+    async def claim(cls, session: AsyncSession):
+        """Locks the next due job, `locked_until` of the result identifies this run like in `IndexJobsCrud.claim`"""
+        next_job = (
+            select(index_metadata_job_table.c.id)
+            .where(index_metadata_job_table.c.run_after <= func.now(),
+                   or_(index_metadata_job_table.c.locked_until.is_(None),
+                       index_metadata_job_table.c.locked_until < func.now()))
+            .order_by(index_metadata_job_table.c.run_after)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        result = await session.execute(
+            update(index_metadata_job_table)
+            .where(index_metadata_job_table.c.id == next_job)
+            .values(attempts=index_metadata_job_table.c.attempts + 1,
+                    locked_until=func.now() + timedelta(seconds=indexing_cred.job_lease))
+            .returning(index_metadata_job_table.c.id, index_metadata_job_table.c.field,
+                       index_metadata_job_table.c.value, index_metadata_job_table.c.attempts,
+                       index_metadata_job_table.c.locked_until)
+        )
+        return result.mappings().first()
+
+    @classmethod
+    def __held_by(cls, job_id: int, locked_until: datetime):
+        return and_(index_metadata_job_table.c.id == job_id, index_metadata_job_table.c.locked_until == locked_until)
+
+    @classmethod
+    async def complete(cls, session: AsyncSession, job_id: int, locked_until: datetime):
+        await session.execute(delete(index_metadata_job_table).where(cls.__held_by(job_id, locked_until)))
+
+    @classmethod
+    async def fail(cls, session: AsyncSession, job_id: int, locked_until: datetime, attempts: int, error: str):
+        ## без ограничения числа попыток: поля в индексе должны догнать БД, когда Elasticsearch станет доступен
+        await session.execute(
+            update(index_metadata_job_table)
+            .where(cls.__held_by(job_id, locked_until))
+            .values(last_error=error, locked_until=None,
+                    run_after=func.now() + timedelta(seconds=indexing_cred.job_backoff(attempts)))
+        )
@@ -1,101 +1,321 @@
-import re, io, nltk, pdfplumber
+import asyncio, contextlib, multiprocessing, os
+from typing import AsyncIterator
+from elasticsearch.helpers import async_bulk
 from fastapi import HTTPException
 
+from app.crud.embedding import Embedding
+from app.crud.expansion import expand_words, english_stop_words
+from app.crud.extraction import send_pdf_pages, preprocess_text
 from app.crud.storage import Storage
+from app.schemas import SearchFiltersScheme
 from app.settings.elastic import elastic_cred, _es
+from app.settings.embedding import embedding_cred
+from app.settings.indexing import indexing_cred
+from app.utils.cache import TTLCache
 
 
-nltk.download('wordnet')
-nltk.download('stopwords')
+class Indexing:
+    ## данные книги, копируемые в каждый документ страницы для фильтрации при поиске
+    METADATA_FIELDS = ['title', 'author', 'author_id', 'genre', 'genre_id', 'published_date', 'avg_mark', 'theme_id']
+    ## index.max_result_window по умолчанию, он же предел num_candidates kNN-запроса
+    MAX_RESULT_WINDOW = 10000
+    ## каждый документ извлекается в своем процессе: зависший процесс завершается, не затрагивая другие книги;
+    ## forkserver не копирует состояние родителя (потоки, соединения), pdfplumber загружается в него один раз
+    __extraction_context = multiprocessing.get_context("forkserver")
+    __extraction_context.set_forkserver_preload(["app.crud.extraction", "pdfplumber"])
+    __extraction_processes: set = set()
+    __extraction_semaphore = asyncio.Semaphore(min(indexing_cred.extraction_workers,
+                                                   indexing_cred.extraction_concurrency))
+    ## версия индекса меняется при каждом изменении книг в этом процессе; изменения из других процессов
+    ## становятся видны по истечении TTL кэша
+    __index_version = 0
+    __search_cache = TTLCache(elastic_cred.search_cache_size, elastic_cred.search_cache_ttl)
 
+    @classmethod
+    def __bump_index_version(cls):
+        cls.__index_version += 1
 
-class Indexing:
-    __english_stop_words = set(nltk.corpus.stopwords.words('english'))
+    @classmethod
+    def search_cache_stats(cls) -> dict:
+        return {**cls.__search_cache.stats(), "index_version": cls.__index_version}
+
+    @classmethod
+    def set_extraction_limits(cls, workers: int, concurrency: int):
+        cls.__extraction_semaphore = asyncio.Semaphore(min(workers, concurrency))
+
+    @classmethod
+    def shutdown_extraction_pool(cls):
+        """Kills extraction processes still running, their books are extracted again by the next job attempt"""
+        for process in list(cls.__extraction_processes):
+            if process.is_alive():
+                process.kill()
+
+    @classmethod
+    def __receive_page(cls, connection) -> tuple[int, str] | str | None:
+        try:
+            return connection.recv()
+        except EOFError:
+            return "extraction process exited without result"
 
     @classmethod
-    def __extract_pdf_text(cls, content: bytes) -> str:
-        with pdfplumber.open(io.BytesIO(content)) as pdf:
-            full_text = ""
-            for page in pdf.pages:
-                full_text += page.extract_text() + "\n"
+    async def __extract_pdf_pages(cls, path: str) -> AsyncIterator[tuple[int, str]]:
+        async with cls.__extraction_semaphore:
+            receiver, sender = cls.__extraction_context.Pipe(duplex=False)
+            process = cls.__extraction_context.Process(target=send_pdf_pages, args=(sender, path), daemon=True)
+            cls.__extraction_processes.add(process)
+            try:
+                ## первый запуск поднимает forkserver, поэтому не в цикле событий
+                await asyncio.to_thread(process.start)
+                sender.close()
+                ## таймаут считает только ожидание процесса, время обработки страниц получателем не входит
+                remaining = indexing_cred.extraction_timeout
+                loop = asyncio.get_running_loop()
+                while True:
+                    started = loop.time()
+                    try:
+                        message = await asyncio.wait_for(asyncio.to_thread(cls.__receive_page, receiver),
+                                                         timeout=remaining)
+                    except asyncio.TimeoutError:
+                        raise HTTPException(status_code=418, detail="Extraction error: timed out")
+                    remaining -= loop.time() - started
+                    if message is None:
+                        break
+                    if isinstance(message, str):
+                        raise HTTPException(status_code=418, detail=f"Extraction error: {message}")
+                    yield message
+            finally:
+                sender.close()
+                if process.pid is not None:
+                    if process.is_alive():
+                        process.kill()
+                    await asyncio.to_thread(process.join)
+                cls.__extraction_processes.discard(process)
+                receiver.close()
         print("BOOK-PROCESSING: Finish extracting")
-        return full_text
 
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def extract_book(cls, book_file_path: str):
+        """Downloads the PDF into a temporary file, gives normalized pages of the book as they are extracted and
+        size of the PDF in bytes"""
+        pdf_path = await Storage.download_to_temp_file(book_file_path)
+        try:
+            async with contextlib.aclosing(cls.__extract_pdf_pages(pdf_path)) as pages:
+                yield pages, os.path.getsize(pdf_path)
+        finally:
+            os.remove(pdf_path)
 
     @classmethod
-    def __preprocess_text(cls, text: str, remove_punctuation: bool = True):
-        text = text.replace("\n", " ").replace("\t", " ")
-        text = re.sub(r'\s+', ' ', text)  ## лишние пробелы
+    def page_documents(cls, book_id: int, metadata, pages: list[tuple[int, str]],
+                       index: str = elastic_cred.books_index, vectors: dict[int, list[list[float]]] | None = None):
+        """Bulk actions for pages of the book. Page ids are stable, so reindexing overwrites them"""
+        ## каждая страница - отдельный документ, поэтому стоимость документа не зависит от размера книги
+        fields = {field: metadata[field] for field in cls.METADATA_FIELDS}
+        for page, content in pages:
+            source = {"book_id": book_id, "page": page, "content": content, **fields}
+            if vectors is not None:
+                source["chunks"] = [{"vector": vector} for vector in vectors.get(page, [])]
+            yield {"_index": index, "_id": f"{book_id}_{page}", "_source": source}
 
-        if remove_punctuation:
-            text = re.sub(r'[^\w\s]', '', text)
+    @classmethod
+    async def page_vectors(cls, pages: list[tuple[int, str]]) -> dict[int, list[list[float]]] | None:
+        if not Embedding.enabled():
+            return None
+        try:
+            return await Embedding.embed_pages(pages)
+        except Exception as e:
+            raise HTTPException(status_code=418, detail=f"Embedding error: {e}")
 
-        text = text.lower()
-        return text
+    @classmethod
+    async def stream_documents(cls, book_id: int, metadata, pages: AsyncIterator[tuple[int, str]],
+                               index: str = elastic_cred.books_index):
+        """Bulk actions for pages as they arrive, embedded in batches of EMBEDDING_BATCH_SIZE pages, so only
+        a batch of the book is held in memory"""
+        batch = []
+        async for page in pages:
+            batch.append(page)
+            if len(batch) >= embedding_cred.batch_size:
+                for document in cls.page_documents(book_id, metadata, batch, index, await cls.page_vectors(batch)):
+                    yield document
+                batch = []
+        for document in cls.page_documents(book_id, metadata, batch, index, await cls.page_vectors(batch)):
+            yield document
 
+    @classmethod
+    async def index_book(cls, book_id: int, metadata, book_file_path: str):
+        ## страницы уходят в bulk-запросы по мере извлечения; при ошибке посреди книги задача повторяется целиком
+        async with cls.extract_book(book_file_path) as (pages, _):
+            try:
+                await cls.__delete_book_documents(book_id)
+                await async_bulk(_es, cls.stream_documents(book_id, metadata, pages),
+                                 chunk_size=elastic_cred.bulk_chunk_size)
+                cls.__bump_index_version()
+                print("BOOK-PROCESSING: Finish indexing")
+            except HTTPException:
+                raise
+            except Exception as e:
+                raise HTTPException(status_code=418, detail=f"Indexation error: {e}")
 
     @classmethod
-    async def index_book(cls, book_id: int, genre: str, book_file_path: str):
-        document = {
-            "genre": genre if genre is not None else "",
-            "content": cls.__preprocess_text(cls.__extract_pdf_text(
-                await Storage.download_file_bytes(book_file_path)
-            ))
-        }
+    async def __delete_book_documents(cls, book_id: int):
+        ## документ книги целиком из индексов до постраничной индексации
+        await _es.options(ignore_status=404).delete(index=elastic_cred.books_index, id=str(book_id))
+        ## также из строящейся новой версии индекса, чтобы удаленная книга не вернулась после переключения псевдонима
+        await _es.delete_by_query(index=[elastic_cred.books_index, elastic_cred.books_indices_pattern],
+                                  query={"term": {"book_id": book_id}}, conflicts="proceed", refresh=True,
+                                  allow_no_indices=True, ignore_unavailable=True)
+
+    @classmethod
+    async def update_metadata(cls, field: str, value: int, fields: dict):
+        """Overwrites `fields` in documents of all books with `field` equal to `value`, without reextraction"""
         try:
-            await _es.index(index=elastic_cred.books_index, id=str(book_id), body=document)
-            print("BOOK-PROCESSING: Finish indexing")
+            await _es.update_by_query(index=[elastic_cred.books_index, elastic_cred.books_indices_pattern],
+                                      query={"term": {field: value}},
+                                      script={"source": "ctx._source.putAll(params.fields)", "lang": "painless",
+                                              "params": {"fields": fields}},
+                                      conflicts="proceed", allow_no_indices=True,
+                                      ignore_unavailable=True)
+            cls.__bump_index_version()
         except Exception as e:
             raise HTTPException(status_code=418, detail=f"Indexation error: {e}")
 
-
     @classmethod
     async def delete_book(cls, book_id: int):
         try:
-            await _es.delete(index=elastic_cred.books_index, id=str(book_id))
+            await cls.__delete_book_documents(book_id)
+            cls.__bump_index_version()
             print(f"BOOK-PROCESSING: Successfully deleted book with ID {book_id}")
         except Exception as e:
             raise HTTPException(status_code=418, detail=f"Deletion error: {e}")
 
 
     @classmethod
-    async def context_search_books(cls, query):
-        search_query = {
-            "multi_match": {
-                "query": cls.__preprocess_text(query),
-                "fields": ["genre", "content"],
-                "type": "most_fields",
-                "operator": "and",
-                "fuzziness": "AUTO"
+    def __search_cache_key(cls, mode: str, query: str, size: int, from_: int, filters: SearchFiltersScheme) -> tuple:
+        return cls.__index_version, mode, query, size, from_, tuple(sorted(filters.model_dump().items()))
+
+    @classmethod
+    def __filter_clauses(cls, filters: SearchFiltersScheme) -> list[dict]:
+        clauses = []
+        for field in ['title', 'author', 'genre']:
+            if getattr(filters, field):
+                clauses.append({"match": {field: {"query": getattr(filters, field), "operator": "and"}}})
+        for field in ['published_date', 'theme_id']:
+            if getattr(filters, field) is not None:
+                clauses.append({"term": {field: getattr(filters, field)}})
+        mark_range = {}
+        if filters.min_mark is not None:
+            mark_range["gte"] = filters.min_mark
+        if filters.max_mark is not None:
+            mark_range["lte"] = filters.max_mark
+        if mark_range:
+            clauses.append({"range": {"avg_mark": mark_range}})
+        return clauses
+
+    @classmethod
+    async def __search(cls, search_query: dict, min_score: float, size: int, from_: int,
+                       filters: SearchFiltersScheme) -> dict:
+        """Page hits collapsed by book: one hit per book with its best matching pages in inner hits"""
+        ## фильтры в filter-контексте не влияют на релевантность и кэшируются в ES
+        filter_clauses = cls.__filter_clauses(filters)
+        if filter_clauses:
+            search_query = {"bool": {"must": [search_query], "filter": filter_clauses}}
+        response = await _es.search(
+            index=elastic_cred.books_index,
+            query=search_query,
+            min_score=min_score,
+            source=False,
+            size=size,
+            from_=from_,
+            collapse={
+                "field": "book_id",
+                "inner_hits": {"name": "pages", "size": elastic_cred.pages_per_hit, "_source": False,
+                               "docvalue_fields": ["page"]}
+            },
+            sort=[{"_score": "desc"}, {"book_id": "asc"}],
+            track_total_hits=False,
+            aggs=cls.__total_books_aggs()
+        )
+        return response.body
+
+    @classmethod
+    def __total_books_aggs(cls) -> dict | None:
+        """Counts matched books, a numeric setting is the threshold below which the count is exact"""
+        track_total_hits = elastic_cred.track_total_hits
+        if track_total_hits is False:
+            return None
+        cardinality = {"field": "book_id"}
+        if track_total_hits is not True:
+            cardinality["precision_threshold"] = track_total_hits
+        return {"books": {"cardinality": cardinality}}
+
+    @classmethod
+    async def context_search_books(cls, query: str, size: int = 10, from_: int = 0,
+                                  filters: SearchFiltersScheme = SearchFiltersScheme()):
+        query = preprocess_text(query)
+        cache_key = cls.__search_cache_key("context", query, size, from_, filters)
+        results = cls.__search_cache.get(cache_key)
+        if results is None:
+            search_query = {
+                "multi_match": {
+                    "query": query,
+                    "fields": ["genre", "content"],
+                    "type": "most_fields",
+                    "operator": "and",
+                    "fuzziness": "AUTO"
+                }
             }
-        }
-        return await _es.search(index=elastic_cred.books_index, query=search_query)
+            results = await cls.__search(search_query, elastic_cred.min_content_score, size, from_, filters)
+            cls.__search_cache.set(cache_key, results)
+        return results
 
 
     @classmethod
     def __expand_and_filter_query(cls, query: str) -> str:
-        query_words = set([word for word in query.split() if word not in cls.__english_stop_words])
-        related_terms = set()
-        for word in query_words:
-            for synset in nltk.corpus.wordnet.synsets(word):
-                for lemma in synset.lemmas():
-                    related_terms.add(lemma.name().replace('_', ' '))
-                for hypernym in synset.hypernyms():
-                    for hypernym_term in hypernym.lemma_names():
-                        related_terms.add(hypernym_term.replace('_', ' '))
-        print(f"BOOK-PROCESSING: Expanded query\n{related_terms}")
-        return " ".join(query_words.union(related_terms))
-
-
-    @classmethod
-    async def semantic_search_books(cls, query: str):
-        search_query = {
-            "multi_match": {
-                "query": cls.__expand_and_filter_query(cls.__preprocess_text(query)),
-                "fields": ["genre^3", "content"],
-                "type": "most_fields",
-                "operator": "or",
-                "fuzziness": "AUTO"
+        stop_words = english_stop_words()
+        query_words = {word for word in query.split() if word not in stop_words}
+        return expand_words(tuple(sorted(query_words)))
+
+
+    @classmethod
+    async def semantic_search_books(cls, query: str, size: int = 10, from_: int = 0,
+                                  filters: SearchFiltersScheme = SearchFiltersScheme()):
+        query = preprocess_text(query)
+        cache_key = cls.__search_cache_key("semantic", query, size, from_, filters)
+        results = cls.__search_cache.get(cache_key)
+        if results is None:
+            search_query = {
+                "multi_match": {
+                    "query": cls.__expand_and_filter_query(query),
+                    "fields": ["genre^3", "content"],
+                    "type": "most_fields",
+                    "operator": "or",
+                    "fuzziness": "AUTO"
+                }
+            }
+            results = await cls.__search(search_query, elastic_cred.min_semantic_score, size, from_, filters)
+            cls.__search_cache.set(cache_key, results)
+        return results
+
+    @classmethod
+    async def knn_search_books(cls, query: str, size: int = 10, from_: int = 0,
+                               filters: SearchFiltersScheme = SearchFiltersScheme()):
+        query = preprocess_text(query)
+        cache_key = cls.__search_cache_key("knn", query, size, from_, filters)
+        results = cls.__search_cache.get(cache_key)
+        if results is None:
+            query_vector = await Embedding.embed_query(query)
+            search_query = {
+                "nested": {
+                    "path": "chunks",
+                    "score_mode": "max",
+                    "query": {"knn": {
+                        "field": "chunks.vector",
+                        "query_vector": query_vector,
+                        "num_candidates": min(max(embedding_cred.num_candidates, size + from_),
+                                              cls.MAX_RESULT_WINDOW)
+                    }}
+                }
             }
-        }
-        return await _es.search(index=elastic_cred.books_index, query=search_query)
+            results = await cls.__search(search_query, embedding_cred.min_score, size, from_, filters)
+            cls.__search_cache.set(cache_key, results)
+        return results
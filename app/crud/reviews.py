@@ -1,12 +1,15 @@
-import datetime
-from sqlalchemy import select, insert, delete, update
+import base64, datetime, json
+from sqlalchemy import select, delete, update, func, case, cast, and_, or_, tuple_, literal, any_, bindparam, \
+    Float, Integer
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 
 from app.crud.books import BooksCrud
 from app.crud.crud_interface import CrudInterface
-from app.models import review_table
-from app.schemas import Review, ReviewCreate, ReviewUpdate, ReviewsFiltersScheme, BookUpdate
+from app.models import review_table, book_table, rating_histogram_table, review_marks
+from app.schemas import Review, ReviewCreate, ReviewUpdate, ReviewsFiltersScheme, RatingHistogram
 
 
 class ReviewsCrud(CrudInterface):
@@ -21,92 +24,261 @@ class ReviewsCrud(CrudInterface):
         return None if result is None else Review(**result)
 
     @classmethod
-    async def get_multiple(cls, session: AsyncSession, filters: ReviewsFiltersScheme = None) -> List[int]:
-        query = select(*[review_table.c[field] for field in cls.REVIEW_FIELDS]).limit(filters.limit).offset(
-            filters.offset)
+    def __encode_cursor(cls, review: Review) -> str:
+        raw = json.dumps([review.book_id, review.last_edit_date.isoformat(), review.id])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @classmethod
+    def __decode_cursor(cls, cursor: str):
+        try:
+            book_id, last_edit_date, review_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return int(book_id), datetime.date.fromisoformat(last_edit_date), int(review_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    @classmethod
+    async def get_multiple(cls, session: AsyncSession,
+                           filters: ReviewsFiltersScheme = None) -> tuple[List[Review], Optional[str]]:
+        """Returns page of reviews, newest first within a book, and cursor of the next page (None for the last one)"""
+        position = tuple_(review_table.c.book_id, review_table.c.last_edit_date, review_table.c.id)
+        query = (
+            select(*[review_table.c[field] for field in cls.REVIEW_FIELDS])
+            .order_by(review_table.c.book_id.desc(), review_table.c.last_edit_date.desc(), review_table.c.id.desc())
+            .limit(filters.limit + 1)
+        )
+        if filters.cursor:
+            if filters.offset:
+                raise ValueError("Cursor can't be combined with offset")
+            query = query.where(position < tuple_(*cls.__decode_cursor(filters.cursor)))
+        else:
+            query = query.offset(filters.offset)
         if filters.book_id is not None:
             query = query.where(review_table.c.book_id == filters.book_id)
         if filters.owner_id is not None:
             query = query.where(review_table.c.owner_id == filters.owner_id)
         result = await session.execute(query)
-        return [review['id'] for review in result.mappings().all()]
+        reviews = [Review(**review) for review in result.mappings().all()]
+        next_cursor = None
+        if len(reviews) > filters.limit:
+            reviews = reviews[:filters.limit]
+            next_cursor = cls.__encode_cursor(reviews[-1])
+        return reviews, next_cursor
 
     @classmethod
-    async def create(cls, session: AsyncSession, model: ReviewCreate, owner_id: int = None) -> Review:
-        book = await BooksCrud.get(session, model.book_id)
-        if book is None:
-            raise ValueError("Book for review not found")
-        if await cls.check_review_by_user_and_book(session, owner_id, book['id']):
-            raise ValueError("Only one review for book from one user")
-        result = await session.execute(
+    def __histogram_deltas(cls, added_mark, removed_mark) -> dict:
+        deltas = {}
+        for mark in review_marks:
+            delta = literal(0)
+            if added_mark is not None:
+                delta = delta + case((added_mark == mark, 1), else_=0)
+            if removed_mark is not None:
+                delta = delta - case((removed_mark == mark, 1), else_=0)
+            deltas[f"mark_{mark}"] = delta
+        return deltas
+
+    @classmethod
+    async def __apply_to_book(cls, session: AsyncSession, changed_review, added_mark=None, removed_mark=None):
+        """Runs the review statement `changed_review` (a CTE returning the review) and updates rating and
+        histogram of its book in the same statement, so concurrent reviews can't overwrite each other's aggregates"""
+        marks_count = func.coalesce(book_table.c.marks_count, 0)
+        avg_mark = func.coalesce(book_table.c.avg_mark, 0)
+        new_marks_count = marks_count + (int(added_mark is not None) - int(removed_mark is not None))
+        mark_delta = literal(0)
+        if added_mark is not None:
+            mark_delta = mark_delta + added_mark
+        if removed_mark is not None:
+            mark_delta = mark_delta - removed_mark
+        new_avg_mark = (avg_mark * marks_count + mark_delta) / cast(new_marks_count, Float)
+        book_update = (
+            update(book_table)
+            .where(book_table.c.id == changed_review.c.book_id)
+            .values(marks_count=new_marks_count, avg_mark=case((new_marks_count > 0, new_avg_mark), else_=0))
+            .returning(book_table.c.id)
+            .cte("book_update")
+        )
+        histogram_deltas = cls.__histogram_deltas(added_mark, removed_mark)
+        histogram_insert = insert(rating_histogram_table).from_select(
+            ["book_id", *histogram_deltas.keys()],
+            select(changed_review.c.book_id, *histogram_deltas.values())
+        )
+        histogram_update = histogram_insert.on_conflict_do_update(
+            index_elements=[rating_histogram_table.c.book_id],
+            ## счетчики не уходят ниже нуля, даже если строка разошлась с отзывами до пересчета
+            set_={column: func.greatest(rating_histogram_table.c[column] + histogram_insert.excluded[column], 0)
+                  for column in histogram_deltas}
+        ).cte("histogram_update")
+        result = (await session.execute(
+            select(*[changed_review.c[field] for field in cls.REVIEW_FIELDS])
+            .add_cte(book_update, histogram_update)
+        )).mappings().first()
+        if result is None:
+            return None
+        review = Review(**{field: result[field] for field in cls.REVIEW_FIELDS})
+        await BooksCrud.sync_index_fields(session, [review.book_id])
+        return review
+
+    @classmethod
+    async def __insert(cls, session: AsyncSession, model: ReviewCreate, owner_id: int) -> Optional[Review]:
+        """Inserts the review, returns None if the user already reviewed the book"""
+        new_review = (
             insert(review_table)
             .values(owner_id=owner_id, last_edit_date=datetime.date.today(), **model.model_dump())
+            .on_conflict_do_nothing(index_elements=[review_table.c.owner_id, review_table.c.book_id])
             .returning(*[review_table.c[field] for field in cls.REVIEW_FIELDS])
+            .cte("new_review")
+        )
+        try:
+            return await cls.__apply_to_book(session, new_review, added_mark=new_review.c.mark)
+        except IntegrityError:
+            raise ValueError("Book for review not found")
+
+    @classmethod
+    async def __update_where(cls, session: AsyncSession, model: ReviewUpdate, *where) -> Optional[Review]:
+        ## блокировка возвращает последнюю версию отзыва, поэтому разница оценок верна и при параллельных изменениях
+        old_review = (
+            select(review_table.c.id, review_table.c.mark)
+            .where(*where)
+            .with_for_update()
+            .cte("old_review")
         )
-        current_avg = book['avg_mark']
-        reviews_count_for_book = book['marks_count']
-        new_reviews_count = reviews_count_for_book + 1
-        new_avg = (current_avg * reviews_count_for_book + model.mark) / new_reviews_count
-        print(new_avg)
-        await BooksCrud.update(session, model.book_id,
-                               BookUpdate(**{'avg_mark': new_avg, 'marks_count': new_reviews_count}))
+        updated_review = (
+            update(review_table)
+            .where(review_table.c.id == old_review.c.id)
+            .values(last_edit_date=datetime.date.today(), mark=model.mark, text=model.text)
+            .returning(*[review_table.c[field] for field in cls.REVIEW_FIELDS], old_review.c.mark.label("old_mark"))
+            .cte("updated_review")
+        )
+        return await cls.__apply_to_book(session, updated_review, added_mark=updated_review.c.mark,
+                                         removed_mark=updated_review.c.old_mark)
+
+    @classmethod
+    async def create(cls, session: AsyncSession, model: ReviewCreate, owner_id: int = None) -> Review:
+        review = await cls.__insert(session, model, owner_id)
+        if review is None:
+            raise ValueError("Only one review for book from one user")
         await session.commit()
-        return Review(**result.mappings().first())
+        return review
 
     @classmethod
-    async def delete(cls, session: AsyncSession, review_id: int, owner_id: int = None):
+    async def create_or_replace(cls, session: AsyncSession, model: ReviewCreate, owner_id: int) -> Review:
+        ## повтор нужен, только если отзыв удалили между вставкой и обновлением
+        for _ in range(3):
+            review = await cls.__insert(session, model, owner_id)
+            if review is None:
+                review = await cls.__update_where(session, model, review_table.c.owner_id == owner_id,
+                                                  review_table.c.book_id == model.book_id)
+            if review is not None:
+                await session.commit()
+                return review
+        raise ValueError("Review is being changed concurrently, try again")
+
+    @classmethod
+    async def __raise_for_missing(cls, session: AsyncSession, review_id: int):
         review = await cls.get(session, review_id)
         if review is None:
             raise ValueError("Review not found")
-        if review.owner_id != owner_id:
-            raise ValueError("It's not your review")
-        book = await BooksCrud.get(session, review.book_id)
-        current_avg = book['avg_mark']
-        reviews_count_for_book = book['marks_count']
-        new_reviews_count = reviews_count_for_book - 1
-        new_avg = (
-                              current_avg * reviews_count_for_book - review.mark) / new_reviews_count if new_reviews_count > 0 else 0
-        await BooksCrud.update(session, review.book_id,
-                                BookUpdate(**{'avg_mark': new_avg, 'marks_count': new_reviews_count}))
-        await session.execute(
-            delete(review_table).where(review_table.c.id == review_id)
+        raise ValueError("It's not your review")
+
+    @classmethod
+    async def delete(cls, session: AsyncSession, review_id: int, owner_id: int = None):
+        deleted_review = (
+            delete(review_table)
+            .where(review_table.c.id == review_id, review_table.c.owner_id == owner_id)
+            .returning(*[review_table.c[field] for field in cls.REVIEW_FIELDS])
+            .cte("deleted_review")
         )
+        review = await cls.__apply_to_book(session, deleted_review, removed_mark=deleted_review.c.mark)
+        if review is None:
+            await cls.__raise_for_missing(session, review_id)
         await session.commit()
         return review
 
     @classmethod
     async def update(cls, session: AsyncSession, element_id: int, owner_id: int, model: ReviewUpdate = None) -> Review:
-        old_review = await cls.get(session, element_id)
-        if old_review is None:
-            raise ValueError("Review not found")
-        if old_review.owner_id != owner_id:
-            raise ValueError("It's not your review")
-        if model.mark is not None and model.mark != old_review.mark:
-            book = await BooksCrud.get(session, old_review.book_id)
-            current_avg = book['avg_mark']
-            reviews_count_for_book = book['marks_count']
-            new_avg = (
-                              current_avg * reviews_count_for_book - old_review.mark + model.mark) / reviews_count_for_book
-            await BooksCrud.update(session, old_review.book_id, BookUpdate(**{'avg_mark': new_avg}))
+        review = await cls.__update_where(session, model, review_table.c.id == element_id,
+                                          review_table.c.owner_id == owner_id)
+        if review is None:
+            await cls.__raise_for_missing(session, element_id)
+        await session.commit()
+        return review
+
+    @classmethod
+    async def reconcile_marks(cls, session: AsyncSession, after_id: int, limit: int) -> tuple[int | None, dict]:
+        """Recomputes aggregates and histograms of the next `limit` books after `after_id` from review_table.
+
+        Returns id of the last book of the batch (None when there are no more books) and new average marks of
+        books whose stored aggregates were wrong.
+        """
+        book_ids = (await session.execute(
+            select(book_table.c.id).where(book_table.c.id > after_id).order_by(book_table.c.id).limit(limit)
+            .with_for_update()
+        )).scalars().all()
+        if not book_ids:
+            return None, {}
+        in_batch = and_(book_table.c.id >= book_ids[0], book_table.c.id <= book_ids[-1])
+        return book_ids[-1], await cls.__recompute_marks(session, in_batch)
+
+    @classmethod
+    async def reconcile_books(cls, session: AsyncSession, book_ids: list[int]) -> dict:
+        """Same as `reconcile_marks` for the given books, returns new average marks of books that were wrong"""
+        in_books = book_table.c.id == any_(bindparam("book_ids", sorted(set(book_ids)), type_=ARRAY(Integer)))
+        await session.execute(select(book_table.c.id).where(in_books).order_by(book_table.c.id).with_for_update())
+        return await cls.__recompute_marks(session, in_books)
+
+    @classmethod
+    async def __recompute_marks(cls, session: AsyncSession, in_batch) -> dict:
+        ## строки книг заблокированы, поэтому отзывы, добавленные во время пересчета, учтутся после него
+        stats = (
+            select(book_table.c.id,
+                   func.count(review_table.c.id).label("marks_count"),
+                   func.coalesce(cast(func.avg(review_table.c.mark), Float), 0).label("avg_mark"))
+            .outerjoin(review_table, review_table.c.book_id == book_table.c.id)
+            .where(in_batch)
+            .group_by(book_table.c.id)
+            .subquery()
+        )
+        histogram = insert(rating_histogram_table).from_select(
+            ["book_id", *[f"mark_{mark}" for mark in review_marks]],
+            select(book_table.c.id,
+                   *[func.count(review_table.c.id).filter(review_table.c.mark == mark) for mark in review_marks])
+            .outerjoin(review_table, review_table.c.book_id == book_table.c.id)
+            .where(in_batch)
+            .group_by(book_table.c.id)
+        )
+        columns = [f"mark_{mark}" for mark in review_marks]
+        await session.execute(histogram.on_conflict_do_update(
+            index_elements=[rating_histogram_table.c.book_id],
+            set_={column: histogram.excluded[column] for column in columns},
+            where=or_(*[rating_histogram_table.c[column] != histogram.excluded[column] for column in columns])
+        ))
         result = await session.execute(
-            update(review_table)
-            .where(review_table.c.id == element_id)
-            .values(last_edit_date=datetime.date.today(), **model.model_dump())
-            .returning(*[review_table.c[field] for field in cls.REVIEW_FIELDS])
+            update(book_table)
+            .where(book_table.c.id == stats.c.id)
+            .where(or_(book_table.c.marks_count.is_distinct_from(stats.c.marks_count),
+                       book_table.c.avg_mark.is_(None),
+                       func.abs(book_table.c.avg_mark - stats.c.avg_mark) > 1e-9))
+            .values(marks_count=stats.c.marks_count, avg_mark=stats.c.avg_mark)
+            .returning(book_table.c.id, book_table.c.avg_mark)
         )
-        await session.commit()
-        return Review(**result.mappings().first())
+        return {row.id: row.avg_mark for row in result}
 
     @classmethod
-    async def check_review_by_user_and_book(cls, session: AsyncSession, owner_id: int, book_id: int) -> bool:
-        result = (await session.execute(
-            select(review_table)
-            .where(
-                review_table.c.owner_id == owner_id,
-                review_table.c.book_id == book_id
-            )
-        )).scalar()
-        return result is not None
+    async def get_histograms(cls, session: AsyncSession, book_ids: list[int]) -> List[RatingHistogram]:
+        """Histograms of books in order of `book_ids`, missing books are skipped"""
+        ids = list(dict.fromkeys(book_ids))
+        query = (
+            select(book_table.c.id,
+                   *[func.coalesce(rating_histogram_table.c[f"mark_{mark}"], 0).label(f"mark_{mark}")
+                     for mark in review_marks])
+            .outerjoin(rating_histogram_table, rating_histogram_table.c.book_id == book_table.c.id)
+            .where(book_table.c.id == any_(bindparam("ids", ids, type_=ARRAY(Integer))))
+        )
+        result = await session.execute(query)
+        histograms = {
+            row['id']: RatingHistogram(book_id=row['id'], counts=[row[f"mark_{mark}"] for mark in review_marks])
+            for row in result.mappings().all()
+        }
+        return [histograms[book_id] for book_id in ids if book_id in histograms]
 
     @classmethod
     async def get_average_mark(cls, session: AsyncSession, book_id: int) -> Optional[float]:
@@ -1,66 +1,174 @@
-import os
-from typing import AsyncGenerator, Any
+import asyncio, hashlib, mimetypes, os, tempfile, urllib.parse, uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Any, BinaryIO, Callable
 from fastapi import UploadFile, HTTPException
-from minio.datatypes import BaseHTTPResponse
+from minio.datatypes import BaseHTTPResponse, Object, Part
 from minio.error import S3Error
-from minio.helpers import ObjectWriteResult
 
 from app.settings import minio_client, minio_cred
 
 
 class Storage:
+    ## minio клиент синхронный, поэтому все обращения к нему уходят в ограниченный пул потоков
+    __executor = ThreadPoolExecutor(max_workers=minio_cred.executor_workers, thread_name_prefix="storage")
+
+    @classmethod
+    async def __run(cls, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(cls.__executor, function, *args)
+
+    @classmethod
+    def shutdown(cls):
+        cls.__executor.shutdown(wait=False, cancel_futures=True)
+
     @classmethod
-    def is_file_exists(cls, path_to_object: str) -> bool:
+    def guess_content_type(cls, filename: str) -> str:
+        return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    @classmethod
+    async def stat_file(cls, path_to_object: str) -> Object | None:
         try:
-            return minio_client.stat_object(minio_cred.bucket_name, path_to_object) is not None
+            return await cls.__run(minio_client.stat_object, minio_cred.bucket_name, path_to_object)
         except S3Error as _:
-            return False
+            return None
+
+    @classmethod
+    async def is_file_exists(cls, path_to_object: str) -> bool:
+        return await cls.stat_file(path_to_object) is not None
 
     @classmethod
-    def __brute_force_path_select(cls, filename: str | None) -> str:
-        if filename is None:
+    def original_filename(cls, file_stat: Object) -> str | None:
+        filename = (file_stat.metadata or {}).get("x-amz-meta-filename")
+        return None if filename is None else urllib.parse.unquote(filename)
+
+    @classmethod
+    def __hash_file(cls, file: BinaryIO) -> str:
+        digest = hashlib.sha256()
+        file.seek(0)
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+        file.seek(0)
+        return digest.hexdigest()
+
+    @classmethod
+    async def __content_addressed_path(cls, file: UploadFile) -> str:
+        if file.filename is None:
             raise HTTPException(status_code=415, detail="The uploaded file must have a name")
-        path = filename
-        name, extension = os.path.splitext(filename)
-        index = 0
-        while cls.is_file_exists(path):
-            index += 1
-            path = f"{name}_{index}{extension}"
-        return path
+        _, extension = os.path.splitext(file.filename)
+        return f"{await cls.__run(cls.__hash_file, file.file)}{extension.lower()}"
 
     @classmethod
-    def upload_file_to_s3(cls, file: UploadFile) -> ObjectWriteResult:
+    async def upload_file_to_s3(cls, file: UploadFile) -> str:
+        """Stores file under the hash of its content, so identical files share one object. Returns object name"""
         try:
-            file_path = cls.__brute_force_path_select(file.filename)
-            return minio_client.put_object(minio_cred.bucket_name, file_path, file.file, file.size)
+            file_path = await cls.__content_addressed_path(file)
+            if await cls.is_file_exists(file_path):
+                return file_path
+            content_type = file.content_type
+            if not content_type or content_type == "application/octet-stream":
+                content_type = cls.guess_content_type(file_path)
+            await cls.__run(minio_client.put_object, minio_cred.bucket_name, file_path, file.file, file.size,
+                            content_type, {"filename": urllib.parse.quote(file.filename)})
+            return file_path
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(409, f"Failed to upload file: {str(e)}")
 
+    ## multipart-загрузки: хеш содержимого заранее неизвестен, поэтому объект получает случайное имя.
+    ## У minio нет публичного API для поэтапной загрузки, используются методы S3-протокола клиента
+    @classmethod
+    async def init_multipart_upload(cls, filename: str) -> tuple[str, str]:
+        """Returns object name and upload id"""
+        _, extension = os.path.splitext(filename)
+        file_path = f"{uuid.uuid4().hex}{extension.lower()}"
+        headers = {
+            "Content-Type": cls.guess_content_type(file_path),
+            "x-amz-meta-filename": urllib.parse.quote(filename)
+        }
+        try:
+            upload_id = await cls.__run(minio_client._create_multipart_upload, minio_cred.bucket_name, file_path,
+                                        headers)
+        except Exception as e:
+            raise HTTPException(409, f"Failed to start upload: {str(e)}")
+        return file_path, upload_id
+
+    @classmethod
+    async def upload_part(cls, file_path: str, upload_id: str, part_number: int, data: bytes | bytearray) -> str:
+        try:
+            return await cls.__run(minio_client._upload_part, minio_cred.bucket_name, file_path, data, None,
+                                   upload_id, part_number)
+        except Exception as e:
+            raise HTTPException(409, f"Failed to upload part: {str(e)}")
+
+    @classmethod
+    async def list_uploaded_parts(cls, file_path: str, upload_id: str) -> list[Part]:
+        def list_all_parts():
+            parts, marker = [], None
+            while True:
+                result = minio_client._list_parts(minio_cred.bucket_name, file_path, upload_id,
+                                                  part_number_marker=marker)
+                parts.extend(result.parts)
+                if not result.is_truncated:
+                    return parts
+                marker = str(result.next_part_number_marker)
+
+        try:
+            return await cls.__run(list_all_parts)
+        except S3Error as e:
+            raise HTTPException(404, f"Upload not found: {str(e)}")
+
+    @classmethod
+    async def complete_multipart_upload(cls, file_path: str, upload_id: str):
+        parts = await cls.list_uploaded_parts(file_path, upload_id)
+        if not parts:
+            raise HTTPException(400, "No parts were uploaded")
+        try:
+            await cls.__run(minio_client._complete_multipart_upload, minio_cred.bucket_name, file_path, upload_id,
+                            [Part(part.part_number, part.etag) for part in parts])
+        except Exception as e:
+            raise HTTPException(409, f"Failed to complete upload: {str(e)}")
+
+    @classmethod
+    async def abort_multipart_upload(cls, file_path: str, upload_id: str):
+        try:
+            await cls.__run(minio_client._abort_multipart_upload, minio_cred.bucket_name, file_path, upload_id)
+        except Exception as e:
+            raise HTTPException(409, f"Failed to abort upload: {str(e)}")
+
     # получить файл из ссылки: file_stream_generator(urllib.parse.unquote(book.pdf_qname))
     @classmethod
-    async def file_stream_generator(cls, full_path: str) -> AsyncGenerator[bytes, Any]:
-        file_response: BaseHTTPResponse = minio_client.get_object(minio_cred.bucket_name, full_path)
+    async def file_stream_generator(cls, full_path: str, offset: int = 0,
+                                    length: int = 0) -> AsyncGenerator[bytes, Any]:
+        file_response: BaseHTTPResponse = await cls.__run(minio_client.get_object, minio_cred.bucket_name, full_path,
+                                                          offset, length)
         try:
-            for chunk in file_response.stream():
+            chunks = file_response.stream()
+            while (chunk := await cls.__run(next, chunks, None)) is not None:
                 yield chunk
         finally:
             file_response.close()
             file_response.release_conn()
 
     @classmethod
-    async def download_file_bytes(cls, full_path: str) -> bytes:
-        data = bytearray()
-        async for chunk in cls.file_stream_generator(full_path):
-            data.extend(chunk)
-        return bytes(data)
+    async def download_to_temp_file(cls, full_path: str) -> str:
+        _, extension = os.path.splitext(full_path)
+        file = tempfile.NamedTemporaryFile(suffix=extension, delete=False)
+        try:
+            with file:
+                async for chunk in cls.file_stream_generator(full_path):
+                    file.write(chunk)
+        except BaseException:
+            os.remove(file.name)
+            raise
+        return file.name
 
     @classmethod
-    def list_files_in_s3(cls):
-        return minio_client.list_objects(minio_cred.bucket_name)
+    async def list_files_in_s3(cls):
+        return await cls.__run(lambda: list(minio_client.list_objects(minio_cred.bucket_name)))
 
     @classmethod
-    def delete_file_in_s3(cls, filename: str):
+    async def delete_file_in_s3(cls, filename: str):
         try:
-            minio_client.remove_object(minio_cred.bucket_name, filename)
+            await cls.__run(minio_client.remove_object, minio_cred.bucket_name, filename)
         except Exception as e:
             raise HTTPException(409, f"Failed to delete file: {str(e)}")
@@ -7,11 +7,15 @@ from sqlalchemy import select, insert, update, delete
 
 from app.crud.crud_interface import CrudInterface
 from app.models import user_table
-from app.schemas import UserRegister, UserLogin, PrivilegesEnum, UserUpdate, UserLogined
-from app.utils import get_password_hash, verify_password
+from app.schemas import UserRegister, UserLogin, PrivilegesEnum, UserUpdate, UserLogined, User
+from app.settings.auth import auth_cred
+from app.utils import get_password_hash, verify_and_update_password
+from app.utils.cache import TTLCache
 
 
 class UsersCrud(CrudInterface):
+    __users_cache = TTLCache(auth_cred.user_cache_size, auth_cred.user_cache_ttl)
+
     @classmethod
     async def get(cls, session: AsyncSession, element_id: int):
         query = select(
@@ -23,6 +27,28 @@ class UsersCrud(CrudInterface):
         result = await session.execute(query)
         return result.mappings().first()
 
+    @classmethod
+    async def get_cached(cls, session_maker, element_id: int) -> User | None:
+        """User for authentication, the session is opened only on cache miss"""
+        user = cls.__users_cache.get(element_id)
+        if user is None:
+            async with session_maker() as session:
+                user = await cls.get(session, element_id)
+            if user is None:
+                return None
+            user = User(**user)
+            cls.__users_cache.set(element_id, user)
+        return user
+
+    @classmethod
+    def invalidate_cached(cls, element_id: int):
+        """Called after commit of the change, otherwise a concurrent request can cache the old row again"""
+        cls.__users_cache.pop(element_id)
+
+    @classmethod
+    def users_cache_stats(cls) -> dict:
+        return cls.__users_cache.stats()
+
     @classmethod
     async def get_multiple(cls, session: AsyncSession, username=None, email=None):
         query = select(
@@ -49,7 +75,7 @@ class UsersCrud(CrudInterface):
             raise HTTPException(status_code=409, detail="User already exists")
 
         user_dict = model.model_dump()
-        user_dict["password_hash"] = get_password_hash(model.password)
+        user_dict["password_hash"] = await get_password_hash(model.password)
         user_dict['privileges'] = "basic"
         user_dict.pop("password")
 
@@ -85,7 +111,7 @@ class UsersCrud(CrudInterface):
                 user_new_dict[key] = value
 
         if model.password is not None:
-            user_new_dict["password_hash"] = get_password_hash(model.password)
+            user_new_dict["password_hash"] = await get_password_hash(model.password)
         user_new_dict.pop("password")
 
         query = update(user_table).where(user_table.c.id == element_id).values(**user_new_dict)
@@ -109,6 +135,12 @@ class UsersCrud(CrudInterface):
         query = select(user_table).where(user_table.c.email == user_data.email)
         result = await session.execute(query)
         user = result.mappings().first()
-        if not user or not verify_password(user_data.password, user["password_hash"]):
+        if not user:
             return None
+        verified, new_hash = await verify_and_update_password(user_data.password, user["password_hash"])
+        if not verified:
+            return None
+        if new_hash is not None:
+            query = update(user_table).where(user_table.c.id == user["id"]).values(password_hash=new_hash)
+            await session.execute(query)
         return user
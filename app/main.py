@@ -1,17 +1,43 @@
+import time
+_import_started = time.perf_counter()
+
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.crud.embedding import Embedding
+from app.crud.indexing import Indexing
+from app.crud.storage import Storage
 from app.routes import books, complex_search, users, authors, genres, storage, reviews
-from app.settings import init_elastic_indexing
-from app.utils import create_tables, close_connections
+from app.settings import init_elastic_indexing, indexing_cred, reviews_cred
+from app.utils import create_tables, close_connections, shutdown_password_hashing
+from app.utils.timing import StartupTimer
+from app.workers.indexing import IndexingWorker
+from app.workers.ratings import RatingsReconciler
+
+startup_timer = StartupTimer(_import_started)
+startup_timer.record("imports")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_elastic_indexing()
-    await create_tables()
+    with startup_timer.stage("elastic"):
+        await init_elastic_indexing()
+    with startup_timer.stage("tables"):
+        await create_tables()
+    if indexing_cred.run_workers_in_api:
+        with startup_timer.stage("workers"):
+            IndexingWorker.start()
+    if reviews_cred.run_reconciler_in_api:
+        RatingsReconciler.start()
+    startup_timer.report()
     yield
+    await RatingsReconciler.stop()
+    await IndexingWorker.stop()
+    Indexing.shutdown_extraction_pool()
+    Embedding.shutdown()
+    Storage.shutdown()
+    shutdown_password_hashing()
     await close_connections()
 
 
@@ -1,9 +1,18 @@
-from sqlalchemy import MetaData, Table, Column, Integer, String, Date, ForeignKey, Float
+from sqlalchemy import MetaData, Table, Column, Integer, String, Date, DateTime, ForeignKey, Float, Index, func, \
+    literal_column, event, DDL
 from sqlalchemy.dialects.postgresql import ENUM
 
 db_metadata = MetaData()
+event.listen(db_metadata, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+
+def trigram_index(name: str, column: Column) -> Index:
+    """GIN trigram index, makes ILIKE '%...%' filters on the column use index scan"""
+    return Index(name, column, postgresql_using="gin", postgresql_ops={column.name: "gin_trgm_ops"})
+
 
 privileges_enum = ENUM("basic", "admin", "moderator", name="privileges", metadata=db_metadata)
+index_job_status_enum = ENUM("pending", "running", "done", "failed", name="index_job_status", metadata=db_metadata)
 
 user_table = Table(
     "user_table",
@@ -14,6 +23,8 @@ user_table = Table(
     Column("password_hash", String(512)),
     Column("privileges", privileges_enum, default="basic")  # TODO: по хорошему надо будет заменить на группы
 )
+trigram_index("ix_user_name_trgm", user_table.c.name)
+trigram_index("ix_user_email_trgm", user_table.c.email)
 
 author_table = Table(
     "author_table",
@@ -21,6 +32,7 @@ author_table = Table(
     Column("id", Integer, primary_key=True),
     Column("name", String(150))
 )
+trigram_index("ix_author_name_trgm", author_table.c.name)
 
 genre_table = Table(
     "genre_table",
@@ -28,6 +40,7 @@ genre_table = Table(
     Column("id", Integer, primary_key=True),
     Column("name", String(150))
 )
+trigram_index("ix_genre_name_trgm", genre_table.c.name)
 
 book_table = Table(
     "book_table",
@@ -39,11 +52,24 @@ book_table = Table(
     Column("genre", ForeignKey(genre_table.c.id), nullable=True),
     Column("published_date", Integer, nullable=True),
     Column("description", String, nullable=True),
-    Column("image_qname", String, nullable=True),
-    Column("pdf_qname", String),
+    Column("image_qname", String, nullable=True, index=True),
+    Column("pdf_qname", String, index=True),
     Column("avg_mark", Float),
     Column("marks_count", Integer)
 )
+trigram_index("ix_book_title_trgm", book_table.c.title)
+trigram_index("ix_book_description_trgm", book_table.c.description)
+
+## выражения сортировки книг; индексы ниже должны совпадать с ними, иначе keyset-пагинация их не использует
+book_sort_keys = {
+    "id": book_table.c.id,
+    "title": func.coalesce(book_table.c.title, literal_column("''")),
+    "avg_mark": func.coalesce(book_table.c.avg_mark, literal_column("0")),
+    "published_date": func.coalesce(book_table.c.published_date, literal_column("0")),
+}
+Index("ix_book_title_id", book_sort_keys["title"], book_table.c.id)
+Index("ix_book_avg_mark_id", book_sort_keys["avg_mark"], book_table.c.id)
+Index("ix_book_published_date_id", book_sort_keys["published_date"], book_table.c.id)
 
 review_table = Table(
     "review_table",
@@ -55,3 +81,45 @@ review_table = Table(
     Column("text", String, nullable=True),
     Column("last_edit_date", Date)
 )
+## число оценок книги от 1 до 5, обновляется вместе с отзывами
+review_marks = range(1, 6)
+rating_histogram_table = Table(
+    "rating_histogram_table",
+    db_metadata,
+    Column("book_id", ForeignKey(book_table.c.id, ondelete='CASCADE'), primary_key=True),
+    *[Column(f"mark_{mark}", Integer, nullable=False, server_default="0") for mark in review_marks]
+)
+
+## один отзыв пользователя на книгу; на нем основана вставка отзыва с ON CONFLICT
+Index("ux_review_owner_id_book_id", review_table.c.owner_id, review_table.c.book_id, unique=True)
+## порядок страниц отзывов, совпадает с сортировкой ReviewsCrud.get_multiple
+Index("ix_review_book_id_last_edit_date_id", review_table.c.book_id, review_table.c.last_edit_date, review_table.c.id)
+
+index_job_table = Table(
+    "index_job_table",
+    db_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("book_id", ForeignKey(book_table.c.id, ondelete='CASCADE'), unique=True, nullable=False),
+    Column("status", index_job_status_enum, nullable=False, default="pending"),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("last_error", String, nullable=True),
+    Column("run_after", DateTime(timezone=True), nullable=False, server_default=func.now()),
+    Column("locked_until", DateTime(timezone=True), nullable=True),
+    Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+    Index("ix_index_job_status_run_after", "status", "run_after")
+)
+
+## отложенное копирование полей в уже проиндексированные страницы: книги (book_id), авторы (author_id), жанры (genre_id)
+index_metadata_job_table = Table(
+    "index_metadata_job_table",
+    db_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("field", String, nullable=False),
+    Column("value", Integer, nullable=False),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("last_error", String, nullable=True),
+    Column("run_after", DateTime(timezone=True), nullable=False, server_default=func.now()),
+    Column("locked_until", DateTime(timezone=True), nullable=True),
+    Index("ux_index_metadata_job_field_value", "field", "value", unique=True),
+    Index("ix_index_metadata_job_run_after", "run_after")
+)
@@ -1,11 +1,10 @@
-import urllib.parse
 from typing import Optional, List
-from fastapi import APIRouter, Query, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Query, HTTPException
 
 from app.crud.books import BooksCrud
-from app.crud.indexing import Indexing
-from app.crud.storage import Storage
-from app.schemas import Book, BookCreate, User, BookUpdate, PrivilegesEnum
+from app.crud.index_jobs import IndexJobsCrud
+from app.schemas import Book, BookCreate, User, BookUpdate, PrivilegesEnum, IndexJob, BooksPage, BooksSortEnum, \
+    SortOrderEnum
 from app.settings import async_session_maker
 from app.utils.auth import user_has_permissions
 
@@ -15,7 +14,8 @@ router = APIRouter(
 )
 
 
-@router.get('/', response_model=List[int], summary='Returns books using search parameters (all of them otherwise)')
+@router.get('/', response_model=BooksPage,
+            summary='Returns page of books using search parameters (all of them otherwise)')
 async def get_books(
         title: Optional[str] = Query(None, description="Filter by book title"),
         author: Optional[str] = Query(None, description="Filter by author"),
@@ -34,12 +34,26 @@ async def get_books(
             description="Maximum mark (from 1 to 5 inclusive)",
             ge=1.0,
             le=5.0
-        )
+        ),
+        sort: BooksSortEnum = Query(BooksSortEnum.ID, description="Sort field"),
+        order: SortOrderEnum = Query(SortOrderEnum.ASC, description="Sort order"),
+        limit: int = Query(50, gt=0, le=100, description="Page size"),
+        cursor: Optional[str] = Query(None, description="Cursor of the page returned by previous request")
 ):
     async with async_session_maker() as session:
-        books = await BooksCrud.get_multiple(session, title, author, genre, published_date, description, min_mark,
-                                             max_mark)
-        return books
+        try:
+            books, next_cursor = await BooksCrud.get_multiple(session, title, author, genre, published_date,
+                                                              description, min_mark, max_mark, sort, order, limit,
+                                                              cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return BooksPage(items=books, next_cursor=next_cursor)
+
+
+@router.get('/batch', response_model=List[Book], summary='Returns data of several books in order of given ids')
+async def get_books_batch(ids: List[int] = Query(..., max_length=100, description="Books ids, up to 100")):
+    async with async_session_maker() as session:
+        return await BooksCrud.get_batch(session, ids)
 
 
 @router.get('/{book_id}', response_model=Book, summary='Returns book data')
@@ -51,18 +65,24 @@ async def get_book(book_id: int):
         return result
 
 
+@router.get('/{book_id}/index_status', response_model=IndexJob, summary='Returns state of book indexing job')
+async def get_book_index_status(book_id: int):
+    async with async_session_maker() as session:
+        result = await IndexJobsCrud.get_by_book(session, book_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail="Indexing job not found")
+        return result
+
+
 @router.post('/create', response_model=int,
              summary='Creates new book. Only for authorized user with moderator privilege')
 async def create_book(
-        book: BookCreate, background_tasks: BackgroundTasks,
+        book: BookCreate,
         user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)
 ):
     async with async_session_maker() as session:
         book_id = await BooksCrud.create(session, book)
         await session.commit()
-        background_tasks.add_task(
-            Indexing.index_book, book_id, book.genre, urllib.parse.unquote(book.pdf_qname)
-        )
         return book_id
 
 
@@ -86,7 +106,4 @@ async def delete_book(book_id: int, user_data: User = user_has_permissions(Privi
         if book is None:
             raise HTTPException(status_code=404, detail="Book not found")
         await session.commit()
-        await Indexing.delete_book(book_id)
-        Storage.delete_file_in_s3(urllib.parse.unquote(book['pdf_qname']))
-        Storage.delete_file_in_s3(urllib.parse.unquote(book['image_qname']))
         return book
@@ -1,7 +1,10 @@
-from fastapi import APIRouter
+import base64, json
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Depends
 
+from app.crud.embedding import Embedding
 from app.crud.indexing import Indexing
-from app.settings import elastic_cred
+from app.schemas import SearchResultsPage, SearchCacheStats, SearchHit, SearchFiltersScheme
 
 router = APIRouter(
     prefix='/complex_search',
@@ -9,15 +12,97 @@ router = APIRouter(
 )
 
 
-@router.get("/context", response_model=list[int])
-async def context_search(query: str) -> list[int]:
-    results: dict = await Indexing.context_search_books(query)
-    return [int(book["_id"]) for book in results['hits']['hits']
-                             if book["_score"] >= elastic_cred.min_content_score]
+## ES не поддерживает search_after вместе со сворачиванием страниц по книге и сортировкой по релевантности,
+## поэтому курсор хранит смещение следующей страницы
+def _decode_search_after(search_after: Optional[str], from_: int, size: int) -> int:
+    if search_after is not None:
+        if from_ != 0:
+            raise HTTPException(status_code=400, detail="searchAfter can't be combined with from")
+        try:
+            from_ = int(json.loads(base64.urlsafe_b64decode(search_after.encode()))["from"])
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid searchAfter")
+    if from_ < 0 or from_ + size > Indexing.MAX_RESULT_WINDOW:
+        raise HTTPException(status_code=400,
+                            detail=f"Results deeper than {Indexing.MAX_RESULT_WINDOW} are not available")
+    return from_
 
 
-@router.get("/semantic", response_model=list[int])
-async def semantic_search(query: str) -> list[int]:
-    results: dict = await Indexing.semantic_search_books(query)
-    return [int(book["_id"]) for book in results['hits']['hits']
-                             if book["_score"] >= elastic_cred.min_semantic_score]
+def _search_filters(
+        title: Optional[str] = Query(None, description="Filter by book title"),
+        author: Optional[str] = Query(None, description="Filter by author"),
+        genre: Optional[str] = Query(None, description="Filter by genre"),
+        published_date: Optional[int] = Query(None, description="Filter by publication year"),
+        theme_id: Optional[int] = Query(None, description="Filter by theme"),
+        min_mark: Optional[float] = Query(None, description="Minimum mark (from 1 to 5 inclusive)", ge=1.0, le=5.0),
+        max_mark: Optional[float] = Query(None, description="Maximum mark (from 1 to 5 inclusive)", ge=1.0, le=5.0)
+) -> SearchFiltersScheme:
+    return SearchFiltersScheme(title=title, author=author, genre=genre, published_date=published_date,
+                               theme_id=theme_id, min_mark=min_mark, max_mark=max_mark)
+
+
+def _search_page(results: dict, size: int, from_: int) -> SearchResultsPage:
+    hits = [
+        SearchHit(
+            book_id=hit["fields"]["book_id"][0],
+            score=hit["_score"] or 0.0,
+            pages=[page["fields"]["page"][0] for page in hit["inner_hits"]["pages"]["hits"]["hits"]
+                   if "page" in page.get("fields", {})]
+        )
+        for hit in results['hits']['hits'] if "book_id" in hit.get("fields", {})
+    ]
+    total = results.get('aggregations', {}).get('books', {}).get('value')
+    next_search_after = None
+    if len(results['hits']['hits']) == size and from_ + 2 * size <= Indexing.MAX_RESULT_WINDOW:
+        next_search_after = base64.urlsafe_b64encode(json.dumps({"from": from_ + size}).encode()).decode()
+    return SearchResultsPage(items=[hit.book_id for hit in hits], hits=hits, total=total,
+                             search_after=next_search_after)
+
+
+@router.get("/context", response_model=SearchResultsPage,
+            summary="Full-text search, optionally filtered by book metadata")
+async def context_search(
+        query: str,
+        size: int = Query(10, gt=0, le=100, description="Page size"),
+        from_: int = Query(0, ge=0, le=10000, alias="from", description="Offset of the page"),
+        search_after: Optional[str] = Query(None, alias="searchAfter", description="Cursor of the next page"),
+        filters: SearchFiltersScheme = Depends(_search_filters)
+) -> SearchResultsPage:
+    from_ = _decode_search_after(search_after, from_, size)
+    results: dict = await Indexing.context_search_books(query, size, from_, filters)
+    return _search_page(results, size, from_)
+
+
+@router.get("/semantic", response_model=SearchResultsPage,
+            summary="Search with query expanded by synonyms, optionally filtered by book metadata")
+async def semantic_search(
+        query: str,
+        size: int = Query(10, gt=0, le=100, description="Page size"),
+        from_: int = Query(0, ge=0, le=10000, alias="from", description="Offset of the page"),
+        search_after: Optional[str] = Query(None, alias="searchAfter", description="Cursor of the next page"),
+        filters: SearchFiltersScheme = Depends(_search_filters)
+) -> SearchResultsPage:
+    from_ = _decode_search_after(search_after, from_, size)
+    results: dict = await Indexing.semantic_search_books(query, size, from_, filters)
+    return _search_page(results, size, from_)
+
+
+@router.get("/knn", response_model=SearchResultsPage,
+            summary="Nearest neighbours search by text embeddings, optionally filtered by book metadata")
+async def knn_search(
+        query: str,
+        size: int = Query(10, gt=0, le=100, description="Page size"),
+        from_: int = Query(0, ge=0, le=10000, alias="from", description="Offset of the page"),
+        search_after: Optional[str] = Query(None, alias="searchAfter", description="Cursor of the next page"),
+        filters: SearchFiltersScheme = Depends(_search_filters)
+) -> SearchResultsPage:
+    if not Embedding.enabled():
+        raise HTTPException(status_code=404, detail="Embedding search is disabled")
+    from_ = _decode_search_after(search_after, from_, size)
+    results: dict = await Indexing.knn_search_books(query, size, from_, filters)
+    return _search_page(results, size, from_)
+
+
+@router.get("/cache_stats", response_model=SearchCacheStats, summary="Returns search results cache statistics")
+async def search_cache_stats() -> SearchCacheStats:
+    return SearchCacheStats(**Indexing.search_cache_stats())
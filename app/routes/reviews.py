@@ -1,8 +1,9 @@
-from typing import List, Annotated
+from typing import Annotated, List
 from fastapi import APIRouter, Query, HTTPException, Depends
 
 from app.crud.reviews import ReviewsCrud
-from app.schemas import User, ReviewsFiltersScheme, Review, ReviewCreate, ReviewUpdate
+from app.schemas import User, ReviewsFiltersScheme, Review, ReviewCreate, ReviewUpdate, ReviewsPage, \
+    RatingHistogram
 from app.settings import async_session_maker
 from app.utils.auth import get_current_user
 
@@ -12,13 +13,33 @@ router = APIRouter(
 )
 
 
-@router.get('/', response_model=List[int], summary="Returns reviews's ids maybe filtered by book and user")
-async def get_reviews(filters: Annotated[ReviewsFiltersScheme, Query()]) -> List[int]:
+@router.get('/', response_model=ReviewsPage,
+            summary="Returns page of reviews's ids (and reviews if asked) maybe filtered by book and user")
+async def get_reviews(filters: Annotated[ReviewsFiltersScheme, Query()]) -> ReviewsPage:
     async with async_session_maker() as session:
         try:
-            return await ReviewsCrud.get_multiple(session, filters)
+            reviews, next_cursor = await ReviewsCrud.get_multiple(session, filters)
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
+        return ReviewsPage(items=[review.id for review in reviews], reviews=reviews if filters.full else None,
+                           next_cursor=next_cursor)
+
+
+@router.get('/histogram', response_model=List[RatingHistogram],
+            summary='Returns marks histograms of several books in order of given ids')
+async def get_histograms(book_ids: List[int] = Query(..., alias="bookIds", max_length=100,
+                                                     description="Books ids, up to 100")) -> List[RatingHistogram]:
+    async with async_session_maker() as session:
+        return await ReviewsCrud.get_histograms(session, book_ids)
+
+
+@router.get('/histogram/{book_id}', response_model=RatingHistogram, summary='Returns marks histogram of book')
+async def get_histogram(book_id: int) -> RatingHistogram:
+    async with async_session_maker() as session:
+        histograms = await ReviewsCrud.get_histograms(session, [book_id])
+        if not histograms:
+            raise HTTPException(status_code=404, detail="Book not found")
+        return histograms[0]
 
 
 @router.get('/{review_id}', response_model=Review, summary='Returns review')
@@ -58,6 +79,16 @@ async def create_review(review: ReviewCreate, user_creds: User = Depends(get_cur
             raise HTTPException(status_code=400, detail=str(e))
 
 
+@router.put('/create_or_replace', response_model=Review,
+            summary='Creates review of the book or replaces the existing one. Only for authorized users')
+async def create_or_replace_review(review: ReviewCreate, user_creds: User = Depends(get_current_user)) -> Review:
+    async with async_session_maker() as session:
+        try:
+            return await ReviewsCrud.create_or_replace(session, review, user_creds.id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.put('/{review_id}/update', response_model=Review, summary="Updates existing review. Only for reviews' owners")
 async def update_review(review_id: int, review: ReviewUpdate, user_creds: User = Depends(get_current_user)) -> Review:
     async with async_session_maker() as session:
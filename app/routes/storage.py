@@ -1,9 +1,12 @@
-import urllib.parse
-from fastapi import APIRouter, File, UploadFile, HTTPException
+import re, urllib.parse
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import APIRouter, File, UploadFile, HTTPException, Request, Query, Path
 from fastapi.responses import StreamingResponse, Response
 
-from app.schemas import FileUploadedScheme, User, PrivilegesEnum
+from app.schemas import FileUploadedScheme, User, PrivilegesEnum, MultipartUploadScheme, UploadedPartScheme
+from app.settings import minio_cred, async_session_maker
 from app.utils.auth import user_has_permissions
+from app.crud.books import BooksCrud
 from app.crud.storage import Storage
 
 router = APIRouter(
@@ -13,36 +16,159 @@ router = APIRouter(
 
 
 @router.post("/", response_model=FileUploadedScheme, summary="Uploads new file. Privileged users only.")
-def upload_file(
+async def upload_file(
         file: UploadFile = File(...),
         user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)
 ):
-    book_object = Storage.upload_file_to_s3(file)
-    return FileUploadedScheme(qname=urllib.parse.quote(book_object.object_name))
+    object_name = await Storage.upload_file_to_s3(file)
+    return FileUploadedScheme(qname=urllib.parse.quote(object_name))
+
+
+@router.post("/multipart", response_model=MultipartUploadScheme,
+             summary="Starts chunked upload of large file. Privileged users only.")
+async def init_multipart_upload(
+        filename: str = Query(..., min_length=1, description="Original file name"),
+        user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)
+):
+    object_name, upload_id = await Storage.init_multipart_upload(filename)
+    return MultipartUploadScheme(qname=urllib.parse.quote(object_name), upload_id=upload_id,
+                                 part_size=minio_cred.multipart_part_size)
+
+
+@router.put("/multipart/{filename}/parts/{part_number}", response_model=UploadedPartScheme,
+            summary="Uploads part of chunked upload from raw request body. All parts except the last one "
+                    "must be at least 5 MiB and at most partSize. Privileged users only.")
+async def upload_part(
+        filename: str, request: Request,
+        part_number: int = Path(..., ge=1, le=10000),
+        upload_id: str = Query(...),
+        user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)
+):
+    data = bytearray()
+    async for chunk in request.stream():
+        data.extend(chunk)
+        if len(data) > minio_cred.multipart_part_size:
+            raise HTTPException(413, f"Part exceeds {minio_cred.multipart_part_size} bytes")
+    if not data:
+        raise HTTPException(400, "Part is empty")
+    etag = await Storage.upload_part(filename, upload_id, part_number, data)
+    return UploadedPartScheme(part_number=part_number, etag=etag, size=len(data))
+
+
+@router.get("/multipart/{filename}", response_model=list[UploadedPartScheme],
+            summary="Returns already uploaded parts, to resume chunked upload. Privileged users only.")
+async def list_uploaded_parts(filename: str, upload_id: str = Query(...),
+                              user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)):
+    return [
+        UploadedPartScheme(part_number=part.part_number, etag=part.etag, size=part.size)
+        for part in await Storage.list_uploaded_parts(filename, upload_id)
+    ]
+
+
+@router.post("/multipart/{filename}/complete", response_model=FileUploadedScheme,
+             summary="Assembles uploaded parts into file. Privileged users only.")
+async def complete_multipart_upload(filename: str, upload_id: str = Query(...),
+                                    user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)):
+    await Storage.complete_multipart_upload(filename, upload_id)
+    return FileUploadedScheme(qname=urllib.parse.quote(filename))
+
+
+@router.delete("/multipart/{filename}", status_code=200,
+               summary="Aborts chunked upload and drops its parts. Privileged users only.")
+async def abort_multipart_upload(filename: str, upload_id: str = Query(...),
+                                 user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)):
+    await Storage.abort_multipart_upload(filename, upload_id)
+    return Response(status_code=200)
+
+
+def _is_not_modified(request: Request, etag: str, last_modified) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """Returns inclusive bounds of the single requested range, None if the header should be ignored"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        start, end = max(size - int(end), 0), size - 1
+    elif end != "" and int(end) < int(start):
+        ## синтаксически неверный диапазон игнорируется (RFC 9110, 14.1.1)
+        return None
+    else:
+        start, end = int(start), min(int(end), size - 1) if end != "" else size - 1
+    if start > end or start >= size:
+        raise HTTPException(416, "Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
 
 
 @router.get("/download/{filename}", response_class=StreamingResponse)
-def download_file(filename: str):
-    if not Storage.is_file_exists(filename):
+async def download_file(filename: str, request: Request):
+    file_stat = await Storage.stat_file(filename)
+    if file_stat is None:
         raise HTTPException(404, "File not found")
+    etag = f'"{file_stat.etag}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(file_stat.last_modified.timestamp(), usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Content-Disposition":
+            f"attachment; filename={urllib.parse.quote(Storage.original_filename(file_stat) or filename)}"
+    }
+    if _is_not_modified(request, etag, file_stat.last_modified):
+        return Response(status_code=304, headers=headers)
+
+    media_type = file_stat.content_type
+    if not media_type or media_type == "application/octet-stream":
+        media_type = Storage.guess_content_type(filename)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range == etag):
+        byte_range = _parse_range(range_header, file_stat.size)
+    if byte_range is None:
+        headers["Content-Length"] = str(file_stat.size)
+        return StreamingResponse(Storage.file_stream_generator(filename), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_stat.size}"
+    headers["Content-Length"] = str(end - start + 1)
     return StreamingResponse(
-        Storage.file_stream_generator(f"{filename}"),
-        media_type="application/octet-stream",
-        headers={"Content-Disposition": f"attachment; filename={urllib.parse.quote(filename)}"}
+        Storage.file_stream_generator(filename, offset=start, length=end - start + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=headers
     )
 
 
 @router.get("/list", response_model=list[FileUploadedScheme])
-def list_files():
+async def list_files():
     return [
         FileUploadedScheme(qname=urllib.parse.quote(obj.object_name))
-        for obj in Storage.list_files_in_s3()
+        for obj in await Storage.list_files_in_s3()
     ]
 
 
-@router.delete("{filename}", status_code=200, summary="Deletes file. Privileged users only.")
-def delete_file(filename: str, user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)):
-    if not Storage.is_file_exists(filename):
+@router.delete("{filename}", status_code=200,
+               summary="Deletes file which isn't used by any book. Privileged users only.")
+async def delete_file(filename: str, user_data: User = user_has_permissions(PrivilegesEnum.MODERATOR)):
+    if not await Storage.is_file_exists(filename):
         raise HTTPException(404, "File not found")
-    Storage.delete_file_in_s3(filename)
+    ## одинаковые загрузки хранятся одним объектом, он может принадлежать и другим книгам
+    async with async_session_maker() as session:
+        if not await BooksCrud.delete_file_if_unreferenced(session, urllib.parse.quote(filename)):
+            raise HTTPException(409, "File is used by a book")
+        await session.commit()
     return Response(status_code=200)
@@ -51,6 +51,7 @@ async def set_privilege_for_user(user_id: int, privilege: PrivilegesEnum,
     async with async_session_maker() as session:
         data = await UsersCrud.set_role_for_user(session, privilege, user_id)
         await session.commit()
+        UsersCrud.invalidate_cached(user_id)
         return data
 
 
@@ -61,6 +62,7 @@ async def update_user_by_id(user_id: int, user_data: UserUpdate,
         async with async_session_maker() as session:
             data = await UsersCrud.update(session, user_id, user_data)
             await session.commit()
+            UsersCrud.invalidate_cached(user_id)
             return data
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='No permission')
@@ -75,6 +77,7 @@ async def delete_user_by_id(user_id: int,
             if data is None:
                 raise HTTPException(status_code=403, detail="User doesn't exist")
             await session.commit()
+            UsersCrud.invalidate_cached(user_id)
             return data
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='No permission')
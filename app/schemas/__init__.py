@@ -3,4 +3,6 @@ from .books import *
 from .genres import *
 from .users import *
 from .storage import *
-from .reviews import *
\ No newline at end of file
+from .reviews import *
+from .index_jobs import *
+from .search import *
@@ -1,7 +1,20 @@
-from typing import Optional
+from enum import Enum
+from typing import Optional, List
 from .base import CamelCaseBaseModel
 
-__all__ = ["Book", "BookCreate", "BookUpdate"]
+__all__ = ["Book", "BookCreate", "BookUpdate", "BooksPage", "BooksSortEnum", "SortOrderEnum"]
+
+
+class BooksSortEnum(str, Enum):
+    ID = "id"
+    TITLE = "title"
+    AVG_MARK = "avg_mark"
+    PUBLISHED_DATE = "published_date"
+
+
+class SortOrderEnum(str, Enum):
+    ASC = "asc"
+    DESC = "desc"
 
 
 class BookCreate(CamelCaseBaseModel):
@@ -34,3 +47,8 @@ class Book(BookCreate):
     id: int
     author: int
     genre: Optional[int]
+
+
+class BooksPage(CamelCaseBaseModel):
+    items: List[int]
+    next_cursor: Optional[str] = None
@@ -0,0 +1,23 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from .base import CamelCaseBaseModel
+
+__all__ = ["IndexJob", "IndexJobStatusEnum"]
+
+
+class IndexJobStatusEnum(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class IndexJob(CamelCaseBaseModel):
+    book_id: int
+    status: IndexJobStatusEnum
+    attempts: int
+    last_error: Optional[str] = None
+    run_after: datetime
+    updated_at: datetime
@@ -1,11 +1,11 @@
 from datetime import date
-from typing import Optional
+from typing import Optional, List
 
 from pydantic import Field
 
 from .base import CamelCaseBaseModel
 
-__all__ = ["ReviewsFiltersScheme", "ReviewUpdate", "ReviewCreate", "Review"]
+__all__ = ["ReviewsFiltersScheme", "ReviewUpdate", "ReviewCreate", "Review", "ReviewsPage", "RatingHistogram"]
 
 
 class ReviewsFiltersScheme(CamelCaseBaseModel):
@@ -13,6 +13,8 @@ class ReviewsFiltersScheme(CamelCaseBaseModel):
     offset: int = Field(0, ge=0)
     book_id: Optional[int] = None
     owner_id: Optional[int] = None
+    full: bool = Field(False, description="Return reviews themselves, not only their ids")
+    cursor: Optional[str] = Field(None, description="Cursor of the page returned by previous request")
 
 
 class ReviewUpdate(CamelCaseBaseModel):
@@ -28,3 +30,14 @@ class Review(ReviewCreate):
     id: int
     owner_id: int
     last_edit_date: date
+
+
+class ReviewsPage(CamelCaseBaseModel):
+    items: List[int]
+    reviews: Optional[List[Review]] = None
+    next_cursor: Optional[str] = None
+
+
+class RatingHistogram(CamelCaseBaseModel):
+    book_id: int
+    counts: List[int] = Field(description="Numbers of marks from 1 to 5")
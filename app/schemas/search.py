@@ -0,0 +1,38 @@
+from typing import List, Optional
+
+from pydantic import Field
+
+from .base import CamelCaseBaseModel
+
+__all__ = ["SearchFiltersScheme", "SearchHit", "SearchResultsPage", "SearchCacheStats"]
+
+
+class SearchFiltersScheme(CamelCaseBaseModel):
+    title: Optional[str] = None
+    author: Optional[str] = None
+    genre: Optional[str] = None
+    published_date: Optional[int] = None
+    theme_id: Optional[int] = None
+    min_mark: Optional[float] = Field(None, ge=1.0, le=5.0)
+    max_mark: Optional[float] = Field(None, ge=1.0, le=5.0)
+
+
+class SearchHit(CamelCaseBaseModel):
+    book_id: int
+    score: float
+    pages: List[int]
+
+
+class SearchResultsPage(CamelCaseBaseModel):
+    items: List[int]
+    hits: List[SearchHit]
+    total: Optional[int] = None
+    search_after: Optional[str] = None
+
+
+class SearchCacheStats(CamelCaseBaseModel):
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+    index_version: int
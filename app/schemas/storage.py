@@ -1,7 +1,20 @@
+from typing import Optional
+
 from .base import CamelCaseBaseModel
 
-__all__ = ["FileUploadedScheme"]
+__all__ = ["FileUploadedScheme", "MultipartUploadScheme", "UploadedPartScheme"]
 
 
 class FileUploadedScheme(CamelCaseBaseModel):
     qname: str
+
+
+class MultipartUploadScheme(FileUploadedScheme):
+    upload_id: str
+    part_size: int
+
+
+class UploadedPartScheme(CamelCaseBaseModel):
+    part_number: int
+    etag: str
+    size: Optional[int] = None
@@ -1,4 +1,7 @@
 from .auth import *
 from .database import *
 from .elastic import *
-from .storage import *
\ No newline at end of file
+from .embedding import *
+from .indexing import *
+from .reviews import *
+from .storage import *
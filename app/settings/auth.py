@@ -1,3 +1,4 @@
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 __all__ = ["auth_cred"]
@@ -7,6 +8,12 @@ class AuthSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file="./config/auth.env")
     secret_key: str
     algorithm: str
+    ## изменения пользователя в других процессах видны по истечении TTL
+    user_cache_size: int = Field(10000, gt=0)
+    user_cache_ttl: float = Field(30.0, gt=0.0)
+    bcrypt_rounds: int = Field(12, ge=4, le=31)
+    hashing_workers: int = Field(4, gt=0)
+    hashing_queue_size: int = Field(64, ge=0)
 
 
 auth_cred = AuthSettings()
@@ -1,8 +1,12 @@
+from typing import Annotated, Optional
 from elasticsearch import AsyncElasticsearch
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-__all__ = ["elastic_cred", "init_elastic_indexing", "delete_elastic_indexing"]
+from app.settings.embedding import embedding_cred
+
+__all__ = ["elastic_cred", "init_elastic_indexing", "delete_elastic_indexing", "create_books_index",
+           "next_books_index_name", "swap_books_alias"]
 
 
 class ElasticSettings(BaseSettings):
@@ -12,6 +16,13 @@ class ElasticSettings(BaseSettings):
     content_score_board: float = Field(gt=0.0)
     semantic_score_board: float = Field(gt=0.0)
     books_index: str = "books"
+    synonyms_path: Optional[str] = None
+    ## число найденных книг: true - точно до 3000, число - точно до него (не больше 40000), дальше приблизительно
+    track_total_hits: bool | Annotated[int, Field(gt=0, le=40000)] = False
+    search_cache_size: int = Field(1024, gt=0)
+    search_cache_ttl: float = Field(60.0, gt=0.0)
+    pages_per_hit: int = Field(3, gt=0)
+    bulk_chunk_size: int = Field(500, gt=0)
 
     @property
     def min_content_score(self):
@@ -25,29 +36,131 @@ class ElasticSettings(BaseSettings):
     def elastic_url(self) -> str:
         return f"http://{self.hostname}:{self.api_port}"
 
+    @property
+    def books_indices_pattern(self) -> str:
+        """Physical indices behind the `books_index` alias"""
+        return f"{self.books_index}_v*"
+
     @property
     def index_settings(self):
-        return {
-            "settings": {"analysis": {"analyzer": {"default": {"type": "standard"}}}},
+        text_filters = ["english_possessive_stemmer", "lowercase", "english_stop", "english_stemmer"]
+        analysis_filters = {
+            "english_stop": {"type": "stop", "stopwords": "_english_"},
+            "english_stemmer": {"type": "stemmer", "language": "english"},
+            "english_possessive_stemmer": {"type": "stemmer", "language": "possessive_english"}
+        }
+        search_filters = text_filters
+        if self.synonyms_path is not None:
+            ## синонимы применяются только при поиске, поэтому их можно обновлять без переиндексации
+            analysis_filters["book_synonyms"] = {
+                "type": "synonym_graph", "synonyms_path": self.synonyms_path, "updateable": True
+            }
+            search_filters = ["english_possessive_stemmer", "lowercase", "book_synonyms", "english_stop",
+                              "english_stemmer"]
+        text_field = {"type": "text", "analyzer": "english_text", "search_analyzer": "english_search"}
+        body = {
+            "settings": {"analysis": {
+                "filter": analysis_filters,
+                "analyzer": {
+                    "english_text": {"type": "custom", "tokenizer": "standard", "filter": text_filters},
+                    "english_search": {"type": "custom", "tokenizer": "standard", "filter": search_filters}
+                }
+            }},
             "mappings": {
                 "dynamic": "strict", "properties": {
-                    "genre": {"type": "text"}, "content": {"type": "text"}
+                    "book_id": {"type": "integer"}, "page": {"type": "integer"}, "content": text_field,
+                    "title": text_field, "author": text_field, "author_id": {"type": "integer"},
+                    "genre": text_field, "genre_id": {"type": "integer"}, "published_date": {"type": "integer"},
+                    "avg_mark": {"type": "float"}, "theme_id": {"type": "integer"}
                 }
             }
         }
+        if embedding_cred.enabled:
+            ## векторы фрагментов страницы; kNN по вложенному полю оценивает страницу по лучшему фрагменту
+            body["mappings"]["properties"]["chunks"] = {"type": "nested", "properties": {"vector": {
+                "type": "dense_vector", "dims": embedding_cred.dims, "index": True, "similarity": "cosine"
+            }}}
+        return body
 
 
 elastic_cred = ElasticSettings()
 _es = AsyncElasticsearch(elastic_cred.elastic_url)
 
 
+async def next_books_index_name() -> str:
+    indices = await _es.indices.get(index=elastic_cred.books_indices_pattern, allow_no_indices=True)
+    versions = [int(name.rsplit("_v", 1)[1]) for name in indices.body if name.rsplit("_v", 1)[1].isdigit()]
+    return f"{elastic_cred.books_index}_v{max(versions, default=0) + 1}"
+
+
+async def create_books_index(name: str, with_alias: bool = False, refresh_interval: str | None = None):
+    body = elastic_cred.index_settings
+    if refresh_interval is not None:
+        body["settings"]["refresh_interval"] = refresh_interval
+    if with_alias:
+        body["aliases"] = {elastic_cred.books_index: {}}
+    await _es.indices.create(index=name, body=body)
+
+
+async def swap_books_alias(new_index: str, delete_old: bool = True):
+    """Atomically points the books alias to `new_index`, index of the same name from before aliases is dropped"""
+    alias = elastic_cred.books_index
+    actions = [{"add": {"index": new_index, "alias": alias}}]
+    if await _es.indices.exists_alias(name=alias):
+        for name in (await _es.indices.get_alias(name=alias)).body:
+            if name == new_index:
+                continue
+            actions.append({"remove_index": {"index": name}} if delete_old else
+                           {"remove": {"index": name, "alias": alias}})
+    elif await _es.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    await _es.indices.update_aliases(actions=actions)
+
+
+def __without_analyzers(field: dict, analyzers: set) -> dict:
+    field = {key: value for key, value in field.items()
+             if key not in ("analyzer", "search_analyzer") or value not in analyzers}
+    if "properties" in field:
+        field["properties"] = {name: __without_analyzers(sub_field, analyzers)
+                               for name, sub_field in field["properties"].items()}
+    return field
+
+
+async def __add_missing_fields(index: str, aliased: bool):
+    ## новые поля добавляются в существующий индекс без переиндексации, изменение анализаторов требует переиндексации
+    mappings = (await _es.indices.get_mapping(index=index)).body
+    existing = set()
+    for mapping in mappings.values():
+        existing.update(mapping["mappings"].get("properties", {}).keys())
+    index_settings = elastic_cred.index_settings
+    properties = index_settings["mappings"]["properties"]
+    missing = {field: value for field, value in properties.items() if field not in existing}
+    if not aliased:
+        ## в индексе без псевдонима нет собственных анализаторов: поля добавляются с анализатором индекса, иначе
+        ## strict-маппинг отклонит документы; анализаторы появятся после перехода на версионный индекс
+        analyzers = set(index_settings["settings"]["analysis"]["analyzer"])
+        missing = {field: __without_analyzers(value, analyzers) for field, value in missing.items()}
+    if missing:
+        await _es.indices.put_mapping(index=index, properties=missing)
+
+
 async def init_elastic_indexing():
-    if not await _es.indices.exists(index=elastic_cred.books_index):
+    if await _es.indices.exists(index=elastic_cred.books_index):
+        aliased = await _es.indices.exists_alias(name=elastic_cred.books_index)
+        if not aliased:
+            print("Индекс создан без псевдонима, для перехода выполните python -m app.workers.reindex --new-version")
+        await __add_missing_fields(elastic_cred.books_index, bool(aliased))
+    else:
         print("Создаем индекс")
-        await _es.indices.create(index=elastic_cred.books_index, body=elastic_cred.index_settings)
+        await create_books_index(await next_books_index_name(), with_alias=True)
 
 
 async def delete_elastic_indexing():
-    if await _es.indices.exists(index=elastic_cred.books_index):
+    ## индекс не удаляется по имени псевдонима и по шаблону (action.destructive_requires_name), только по именам
+    indices = await _es.indices.get(index=[elastic_cred.books_index, elastic_cred.books_indices_pattern],
+                                    allow_no_indices=True, ignore_unavailable=True)
+    names = [name for name in indices.body
+             if name == elastic_cred.books_index or name.rsplit("_v", 1)[1].isdigit()]
+    if names:
         print("Удаляем индекс")
-        await _es.indices.delete(index=elastic_cred.books_index)
+        await _es.indices.delete(index=names)
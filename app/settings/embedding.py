@@ -0,0 +1,25 @@
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+__all__ = ["embedding_cred"]
+
+
+class EmbeddingSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix='EMBEDDING_', env_file="./config/embedding.env",
+                                      protected_namespaces=())
+    enabled: bool = False
+    ## "hashing" - детерминированная модель без весов для тестов, иначе путь к локальной модели transformers
+    model: str = "hashing"
+    dims: int = Field(384, gt=0)
+    max_length: int = Field(256, gt=0)
+    threads: int = Field(0, ge=0)
+
+    chunk_words: int = Field(150, gt=0)
+    chunk_overlap: int = Field(30, ge=0)
+    batch_size: int = Field(32, gt=0)
+
+    num_candidates: int = Field(100, gt=0)
+    min_score: float = Field(0.0, ge=0.0)
+
+
+embedding_cred = EmbeddingSettings()
@@ -0,0 +1,30 @@
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+__all__ = ["indexing_cred"]
+
+
+class IndexingSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix='INDEXING_', env_file="./config/indexing.env")
+    extraction_workers: int = Field(2, gt=0)
+    extraction_concurrency: int = Field(2, gt=0)
+    extraction_timeout: float = Field(300.0, gt=0.0)
+
+    nltk_data_path: str = "./data/nltk"
+    expansions_path: str = "./data/wordnet_expansions.tsv"
+    expansion_cache_size: int = Field(4096, gt=0)
+
+    run_workers_in_api: bool = True
+    job_concurrency: int = Field(2, gt=0)
+    job_max_attempts: int = Field(5, gt=0)
+    job_backoff_base: float = Field(10.0, gt=0.0)
+    job_backoff_max: float = Field(3600.0, gt=0.0)
+    job_poll_interval: float = Field(2.0, gt=0.0)
+    job_lease: float = Field(900.0, gt=0.0)
+
+    def job_backoff(self, attempts: int) -> float:
+        """Delay in seconds before the next attempt of a job failed `attempts` times"""
+        return min(self.job_backoff_base * 2 ** (attempts - 1), self.job_backoff_max)
+
+
+indexing_cred = IndexingSettings()
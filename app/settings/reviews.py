@@ -0,0 +1,14 @@
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+__all__ = ["reviews_cred"]
+
+
+class ReviewsSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_prefix='REVIEWS_', env_file="./config/reviews.env")
+    run_reconciler_in_api: bool = True
+    reconcile_interval: float = Field(3600.0, gt=0.0)
+    reconcile_batch_size: int = Field(1000, gt=0)
+
+
+reviews_cred = ReviewsSettings()
@@ -1,4 +1,6 @@
+import urllib3
 from minio import Minio
+from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 __all__ = ["minio_client", "minio_cred"]
@@ -12,6 +14,11 @@ class MinioSettings(BaseSettings):
     port: int
     login: str
     password: str
+    max_connections: int = Field(16, gt=0)
+    executor_workers: int = Field(16, gt=0)
+    timeout: float = Field(300.0, gt=0.0)
+    ## часть целиком держится в памяти API-воркера на время загрузки
+    multipart_part_size: int = Field(16 * 1024 * 1024, ge=5 * 1024 * 1024, le=128 * 1024 * 1024)
 
     @property
     def minio_url(self) -> str:
@@ -25,5 +32,10 @@ minio_client = Minio(
     minio_cred.minio_url,
     access_key=minio_cred.login,
     secret_key=minio_cred.password,
-    secure=False
+    secure=False,
+    http_client=urllib3.PoolManager(
+        maxsize=minio_cred.max_connections,
+        timeout=urllib3.Timeout(connect=10.0, read=minio_cred.timeout),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
 )
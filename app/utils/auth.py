@@ -44,10 +44,9 @@ async def get_current_user(token: str = Depends(get_token)):
     user_id = payload.get('sub')
     if not user_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='User author_id wasn\'t found')
-    async with async_session_maker() as session:
-        user = await UsersCrud.get(session, int(user_id))
-        if not user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='User not found')
+    user = await UsersCrud.get_cached(async_session_maker, int(user_id))
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='User not found')
     return user
 
 
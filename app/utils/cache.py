@@ -0,0 +1,42 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+__all__ = ["TTLCache"]
+
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire `ttl` seconds after being set"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self.__data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.__data[key]
+            self.misses += 1
+            return default
+        self.__data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: Hashable, value: Any):
+        self.__data[key] = (time.monotonic() + self.__ttl, value)
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.__maxsize:
+            self.__data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self.__data.pop(key, None)
+
+    def clear(self):
+        self.__data.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.__data), "maxsize": self.__maxsize}
@@ -1,14 +1,46 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
-__all__ = ["get_password_hash", "verify_password"]
+from app.settings.auth import auth_cred
 
+__all__ = ["get_password_hash", "verify_password", "verify_and_update_password", "shutdown_password_hashing"]
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+## хэши с меньшей стоимостью считаются устаревшими и пересчитываются при входе
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=auth_cred.bcrypt_rounds,
+                           bcrypt__min_rounds=auth_cred.bcrypt_rounds)
+## bcrypt отпускает GIL, поэтому хэширование в потоках не блокирует цикл событий
+_hashing_executor = ThreadPoolExecutor(max_workers=auth_cred.hashing_workers, thread_name_prefix="bcrypt")
+_admitted = 0
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
 
+async def _run_hashing(func, *args):
+    """Runs bcrypt in the pool, requests over the pool and queue capacity are rejected instead of waiting"""
+    global _admitted
+    if _admitted >= auth_cred.hashing_workers + auth_cred.hashing_queue_size:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many password checks, try again later", headers={"Retry-After": "1"})
+    _admitted += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hashing_executor, func, *args)
+    finally:
+        _admitted -= 1
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+
+async def get_password_hash(password: str) -> str:
+    return await _run_hashing(pwd_context.hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run_hashing(pwd_context.verify, plain_password, hashed_password)
+
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """Verifies the password and returns its new hash if the stored one is outdated"""
+    return await _run_hashing(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+def shutdown_password_hashing():
+    _hashing_executor.shutdown(wait=False, cancel_futures=True)
@@ -1,12 +1,77 @@
+from sqlalchemy import select, insert, delete, func, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+
 from app.settings import db_engine
-from app.models import db_metadata
+from app.models import db_metadata, review_table, rating_histogram_table, review_marks
 
 __all__ = ["create_tables", "close_connections", "delete_tables"]
 
 
+def _delete_duplicate_reviews(connection) -> list[int]:
+    """Keeps the latest review of every user for a book, the unique index can't be built over duplicates.
+    Returns ids of books whose reviews were deleted"""
+    if "ux_review_owner_id_book_id" in {index["name"] for index in inspect(connection).get_indexes("review_table")}:
+        return []
+    ranked = select(
+        review_table.c.id,
+        func.row_number().over(
+            partition_by=[review_table.c.owner_id, review_table.c.book_id],
+            order_by=[review_table.c.last_edit_date.desc().nulls_last(), review_table.c.id.desc()]
+        ).label("position")
+    ).subquery()
+    book_ids = connection.execute(
+        delete(review_table).where(review_table.c.id.in_(select(ranked.c.id).where(ranked.c.position > 1)))
+        .returning(review_table.c.book_id)
+    ).scalars().all()
+    if book_ids:
+        print(f"Удалено повторных отзывов: {len(book_ids)}")
+    return sorted(set(book_ids))
+
+
+async def _reconcile_books(connection, book_ids: list[int]) -> None:
+    """Recomputes marks of books that counted deleted reviews, in the transaction of the deletion"""
+    ## app.crud импортирует app.utils
+    from app.crud.books import BooksCrud
+    from app.crud.reviews import ReviewsCrud
+    session = AsyncSession(bind=connection)
+    changed = await ReviewsCrud.reconcile_books(session, book_ids)
+    if changed:
+        await BooksCrud.sync_index_fields(session, list(changed))
+    await session.close()
+
+
+def _has_histograms(connection) -> bool:
+    return inspect(connection).has_table(rating_histogram_table.name)
+
+
+def _fill_histograms(connection) -> None:
+    """Counts marks of reviews written before histograms were introduced, the incremental updates of review writes
+    start from these counts"""
+    connection.execute(insert(rating_histogram_table).from_select(
+        ["book_id", *[f"mark_{mark}" for mark in review_marks]],
+        select(review_table.c.book_id,
+               *[func.count(review_table.c.id).filter(review_table.c.mark == mark) for mark in review_marks])
+        .group_by(review_table.c.book_id)
+    ))
+
+
+def _create_missing_indexes(connection) -> None:
+    ## create_all не добавляет новые индексы в уже существующие таблицы
+    for table in db_metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
 async def create_tables() -> None:
     async with db_engine.begin() as connection:
+        has_histograms = await connection.run_sync(_has_histograms)
         await connection.run_sync(db_metadata.create_all)
+        deduplicated = await connection.run_sync(_delete_duplicate_reviews)
+        if not has_histograms:
+            await connection.run_sync(_fill_histograms)
+        if deduplicated:
+            await _reconcile_books(connection, deduplicated)
+        await connection.run_sync(_create_missing_indexes)
 
 
 async def close_connections():
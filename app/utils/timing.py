@@ -0,0 +1,28 @@
+import time
+from contextlib import contextmanager
+
+__all__ = ["StartupTimer"]
+
+
+class StartupTimer:
+    """Collects durations of startup stages, imports are measured from `started` to the first `record` call"""
+
+    def __init__(self, started: float):
+        self.__started = started
+        self.__last = started
+        self.__stages: dict[str, float] = {}
+
+    def record(self, stage: str):
+        now = time.perf_counter()
+        self.__stages[stage] = now - self.__last
+        self.__last = now
+
+    @contextmanager
+    def stage(self, stage: str):
+        self.__last = time.perf_counter()
+        yield
+        self.record(stage)
+
+    def report(self):
+        stages = ", ".join(f"{stage} {duration:.3f}s" for stage, duration in self.__stages.items())
+        print(f"STARTUP: {stages}, total {time.perf_counter() - self.__started:.3f}s")
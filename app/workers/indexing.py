@@ -0,0 +1,148 @@
+import asyncio, urllib.parse
+
+from app.crud.authors import AuthorsCrud
+from app.crud.books import BooksCrud
+from app.crud.genres import GenresCrud
+from app.crud.index_jobs import IndexJobsCrud, IndexMetadataJobsCrud
+from app.crud.embedding import Embedding
+from app.crud.indexing import Indexing
+from app.crud.storage import Storage
+from app.settings import async_session_maker
+from app.settings.indexing import indexing_cred
+from app.utils import close_connections
+
+
+## отдельный процесс воркера: python -m app.workers.indexing
+class IndexingWorker:
+    __stop_event: asyncio.Event | None = None
+    __tasks: list[asyncio.Task] = []
+
+    @classmethod
+    async def __process_job(cls, book_id: int):
+        async with async_session_maker() as session:
+            book = await BooksCrud.get_for_indexing(session, book_id)
+            if book is None:
+                return
+        await Indexing.index_book(book_id, book, urllib.parse.unquote(book['pdf_qname']))
+
+    @classmethod
+    async def __run_job(cls, job):
+        try:
+            await cls.__process_job(job['book_id'])
+        except Exception as e:
+            print(f"BOOK-PROCESSING: Indexing job for book {job['book_id']} failed: {e}")
+            async with async_session_maker() as session:
+                await IndexJobsCrud.fail(session, job['id'], job['locked_until'], job['attempts'], str(e))
+                await session.commit()
+            return
+
+        async with async_session_maker() as session:
+            completed = await IndexJobsCrud.complete(session, job['id'], job['locked_until'])
+            book = None if completed else await BooksCrud.get(session, job['book_id'])
+            await session.commit()
+        if not completed and book is None:
+            ## книгу удалили во время индексации: ее страницы записаны уже после удаления документов
+            await Indexing.delete_book(job['book_id'])
+
+    @classmethod
+    async def __metadata_fields(cls, field: str, value: int) -> dict | None:
+        """Current values of the indexed fields the job copies, None if the row is already deleted"""
+        async with async_session_maker() as session:
+            if field == "author_id":
+                author = await AuthorsCrud.get(session, value)
+                return None if author is None else {"author": author['name']}
+            if field == "genre_id":
+                genre = await GenresCrud.get(session, value)
+                return None if genre is None else {"genre": genre['name']}
+            book = await BooksCrud.get_for_indexing(session, value)
+        return None if book is None else {name: book[name] for name in Indexing.METADATA_FIELDS}
+
+    @classmethod
+    async def __run_metadata_job(cls, job):
+        try:
+            fields = await cls.__metadata_fields(job['field'], job['value'])
+            if fields is not None:
+                await Indexing.update_metadata(job['field'], job['value'], fields)
+        except Exception as e:
+            error = getattr(e, "detail", str(e))
+            print(f"BOOK-PROCESSING: Metadata update for {job['field']}={job['value']} failed: {error}")
+            async with async_session_maker() as session:
+                await IndexMetadataJobsCrud.fail(session, job['id'], job['locked_until'], job['attempts'], error)
+                await session.commit()
+            return
+
+        async with async_session_maker() as session:
+            await IndexMetadataJobsCrud.complete(session, job['id'], job['locked_until'])
+            await session.commit()
+
+    @classmethod
+    async def __wait(cls, stop_event: asyncio.Event):
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=indexing_cred.job_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    @classmethod
+    async def __run(cls, stop_event: asyncio.Event):
+        while not stop_event.is_set():
+            ## ошибки БД (перезапуск, разрыв соединения) не должны останавливать воркер
+            try:
+                async with async_session_maker() as session:
+                    job = await IndexJobsCrud.claim(session)
+                    await session.commit()
+                if job is None:
+                    await cls.__wait(stop_event)
+                    continue
+                await cls.__run_job(job)
+            except Exception as e:
+                print(f"BOOK-PROCESSING: Indexing worker error: {e}")
+                await cls.__wait(stop_event)
+
+    @classmethod
+    async def __run_metadata(cls, stop_event: asyncio.Event):
+        ## отдельный цикл: обновления полей не ждут извлечения текста больших книг
+        while not stop_event.is_set():
+            try:
+                async with async_session_maker() as session:
+                    job = await IndexMetadataJobsCrud.claim(session)
+                    await session.commit()
+                if job is None:
+                    await cls.__wait(stop_event)
+                    continue
+                await cls.__run_metadata_job(job)
+            except Exception as e:
+                print(f"BOOK-PROCESSING: Metadata worker error: {e}")
+                await cls.__wait(stop_event)
+
+    @classmethod
+    def start(cls, concurrency: int = indexing_cred.job_concurrency):
+        cls.__stop_event = asyncio.Event()
+        cls.__tasks = [asyncio.create_task(cls.__run(cls.__stop_event)) for _ in range(concurrency)]
+        cls.__tasks.append(asyncio.create_task(cls.__run_metadata(cls.__stop_event)))
+
+    @classmethod
+    async def stop(cls):
+        if cls.__stop_event is None:
+            return
+        cls.__stop_event.set()
+        ## прерванные задачи вернутся в очередь по истечении аренды
+        for task in cls.__tasks:
+            task.cancel()
+        await asyncio.gather(*cls.__tasks, return_exceptions=True)
+        cls.__stop_event, cls.__tasks = None, []
+
+    @classmethod
+    async def run_forever(cls):
+        cls.start()
+        try:
+            await asyncio.gather(*cls.__tasks)
+        finally:
+            await cls.stop()
+            Indexing.shutdown_extraction_pool()
+            Embedding.shutdown()
+            Storage.shutdown()
+            await close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(IndexingWorker.run_forever())
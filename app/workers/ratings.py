@@ -0,0 +1,82 @@
+import argparse, asyncio
+from sqlalchemy import select, func
+
+from app.crud.books import BooksCrud
+from app.crud.reviews import ReviewsCrud
+from app.settings import async_session_maker, db_engine
+from app.settings.reviews import reviews_cred
+from app.utils import close_connections
+
+
+## сверка оценок книг с отзывами и пересборка гистограмм: python -m app.workers.ratings --help
+class RatingsReconciler:
+    """Periodically recomputes avg_mark, marks_count and marks histograms of all books from review_table in
+    batches, fixing aggregates drifted by rounding of incremental updates or by direct changes of review_table"""
+    __task: asyncio.Task | None = None
+    ## ключ advisory-блокировки: сверку выполняет один процесс из всех API-воркеров и запусков из консоли
+    __LOCK_KEY = 0x7261_7469
+
+    @classmethod
+    async def run_once(cls, batch_size: int = reviews_cred.reconcile_batch_size) -> int:
+        async with db_engine.connect() as connection:
+            ## блокировка уровня сессии держится без открытой транзакции; соединение закрывается, а не возвращается
+            ## в пул, поэтому блокировка снимается и при отмене задачи
+            await connection.execution_options(isolation_level="AUTOCOMMIT")
+            try:
+                if not await connection.scalar(select(func.pg_try_advisory_lock(cls.__LOCK_KEY))):
+                    print("RATINGS: reconciliation is already running in another process")
+                    return 0
+                return await cls.__reconcile(batch_size)
+            finally:
+                await connection.invalidate()
+
+    @classmethod
+    async def __reconcile(cls, batch_size: int) -> int:
+        fixed = 0
+        last_id = 0
+        while True:
+            async with async_session_maker() as session:
+                last_id, changed = await ReviewsCrud.reconcile_marks(session, last_id, batch_size)
+                await BooksCrud.sync_index_fields(session, list(changed))
+                await session.commit()
+            fixed += len(changed)
+            if last_id is None:
+                break
+        print(f"RATINGS: reconciled, {fixed} books fixed")
+        return fixed
+
+    @classmethod
+    async def __run(cls):
+        while True:
+            await asyncio.sleep(reviews_cred.reconcile_interval)
+            try:
+                await cls.run_once()
+            except Exception as e:
+                print(f"RATINGS: reconciliation failed: {e}")
+
+    @classmethod
+    def start(cls):
+        cls.__task = asyncio.create_task(cls.__run())
+
+    @classmethod
+    async def stop(cls):
+        if cls.__task is None:
+            return
+        cls.__task.cancel()
+        await asyncio.gather(cls.__task, return_exceptions=True)
+        cls.__task = None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Recomputes marks and marks histograms of books from reviews")
+    parser.add_argument("--batch-size", type=int, default=reviews_cred.reconcile_batch_size,
+                        help="Books recomputed per transaction")
+    args = parser.parse_args()
+    try:
+        await RatingsReconciler.run_once(args.batch_size)
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,221 @@
+import argparse, asyncio, collections, datetime, json, os, time, urllib.parse
+from elasticsearch.helpers import async_streaming_bulk
+
+from app.crud.books import BooksCrud
+from app.crud.index_jobs import IndexJobsCrud
+from app.crud.embedding import Embedding
+from app.crud.indexing import Indexing
+from app.crud.storage import Storage
+from app.settings import async_session_maker, elastic_cred, indexing_cred
+from app.settings.elastic import _es, create_books_index, next_books_index_name, swap_books_alias
+from app.utils import close_connections
+
+
+## полная переиндексация каталога: python -m app.workers.reindex --help
+class Reindexer:
+    """Streams book_table in id order, extracts books in parallel and feeds their pages to ES bulk requests.
+
+    The checkpoint holds the greatest book id such that every book up to it is indexed, so an interrupted
+    run resumes from it. A failed book is put into the indexing job queue before the checkpoint can pass it.
+
+    With a new index version the pages go to a fresh physical index that replaces the one behind the books
+    alias in a single atomic alias update once the run is over, searches keep using the old index meanwhile.
+    """
+
+    def __init__(self, index: str, concurrency: int, bulk_concurrency: int, chunk_size: int, checkpoint_path: str):
+        self.__index = index
+        self.__concurrency = concurrency
+        self.__bulk_concurrency = bulk_concurrency
+        self.__chunk_size = chunk_size
+        self.__checkpoint_path = checkpoint_path
+        self.__queue: asyncio.Queue = asyncio.Queue(maxsize=chunk_size * bulk_concurrency * 2)
+        self.__dispatched: collections.deque[int] = collections.deque()
+        self.__remaining_pages: dict[int, int] = {}
+        self.__finished: set[int] = set()
+        self.__failed: set[int] = set()
+        self.__checkpoint = 0
+        self.__books_done = 0
+        self.__bytes_done = 0
+        self.__started = time.perf_counter()
+        self.__last_report = self.__started
+
+    @staticmethod
+    def checkpoint_index(checkpoint_path: str) -> str | None:
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path) as file:
+            return json.load(file)["index"]
+
+    def load_checkpoint(self) -> int:
+        if os.path.exists(self.__checkpoint_path):
+            with open(self.__checkpoint_path) as file:
+                checkpoint = json.load(file)
+            if checkpoint["index"] == self.__index:
+                self.__checkpoint = checkpoint["last_book_id"]
+        return self.__checkpoint
+
+    def __save_checkpoint(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.__checkpoint_path)), exist_ok=True)
+        with open(self.__checkpoint_path, "w") as file:
+            json.dump({"index": self.__index, "last_book_id": self.__checkpoint}, file)
+
+    def __report(self, force: bool = False):
+        now = time.perf_counter()
+        if not force and now - self.__last_report < 5:
+            return
+        self.__last_report = now
+        elapsed = max(now - self.__started, 1e-9)
+        print(f"REINDEX: {self.__books_done} books, {self.__bytes_done / 2 ** 20:.1f} MB in {elapsed:.1f}s "
+              f"({self.__books_done / elapsed:.2f} books/s, {self.__bytes_done / 2 ** 20 / elapsed:.2f} MB/s), "
+              f"checkpoint {self.__checkpoint}, failed {len(self.__failed)}")
+
+    def __finish_book(self, book_id: int):
+        self.__finished.add(book_id)
+        self.__books_done += 1
+        advanced = False
+        while self.__dispatched and self.__dispatched[0] in self.__finished:
+            self.__checkpoint = self.__dispatched.popleft()
+            self.__finished.discard(self.__checkpoint)
+            advanced = True
+        if advanced:
+            self.__save_checkpoint()
+        self.__report()
+
+    async def __fail_book(self, book_id: int):
+        if book_id in self.__failed:
+            return
+        self.__failed.add(book_id)
+        async with async_session_maker() as session:
+            await IndexJobsCrud.enqueue(session, book_id)
+            await session.commit()
+
+    def __page_done(self, book_id: int):
+        self.__remaining_pages[book_id] -= 1
+        if self.__remaining_pages[book_id] == 0:
+            del self.__remaining_pages[book_id]
+            self.__finish_book(book_id)
+
+    async def __extract(self, book, semaphore: asyncio.Semaphore):
+        ## число страниц заранее неизвестно: единица держит книгу незавершенной до конца извлечения
+        self.__remaining_pages[book['id']] = 1
+        try:
+            async with Indexing.extract_book(urllib.parse.unquote(book['pdf_qname'])) as (pages, size):
+                self.__bytes_done += size
+                async for document in Indexing.stream_documents(book['id'], book, pages, self.__index):
+                    self.__remaining_pages[book['id']] += 1
+                    await self.__queue.put(document)
+        except Exception as e:
+            print(f"REINDEX: book {book['id']} failed: {e}")
+            await self.__fail_book(book['id'])
+        finally:
+            semaphore.release()
+        self.__page_done(book['id'])
+
+    async def __documents(self):
+        while (document := await self.__queue.get()) is not None:
+            yield document
+
+    async def __bulk(self):
+        async for ok, item in async_streaming_bulk(_es, self.__documents(), chunk_size=self.__chunk_size,
+                                                   raise_on_error=False, raise_on_exception=False,
+                                                   max_retries=3):
+            book_id = int(item["index"]["_id"].split("_")[0])
+            if not ok:
+                await self.__fail_book(book_id)
+            self.__page_done(book_id)
+
+    async def __produce(self, batch_size: int, extract_tasks: set[asyncio.Task]):
+        semaphore = asyncio.Semaphore(self.__concurrency)
+        last_id = self.__checkpoint
+        while True:
+            async with async_session_maker() as session:
+                books = await BooksCrud.get_indexing_batch(session, last_id, batch_size)
+            if not books:
+                break
+            for book in books:
+                await semaphore.acquire()
+                self.__dispatched.append(book['id'])
+                task = asyncio.create_task(self.__extract(book, semaphore))
+                extract_tasks.add(task)
+                task.add_done_callback(extract_tasks.discard)
+            last_id = books[-1]['id']
+
+        await asyncio.gather(*extract_tasks)
+        for _ in range(self.__bulk_concurrency):
+            await self.__queue.put(None)
+
+    async def run(self, batch_size: int = 500):
+        extract_tasks: set[asyncio.Task] = set()
+        tasks = [asyncio.create_task(self.__produce(batch_size, extract_tasks)),
+                 *[asyncio.create_task(self.__bulk()) for _ in range(self.__bulk_concurrency)]]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            ## ошибка соединения с ES завершает поток bulk-запросов, без него извлечение ждало бы очередь вечно
+            running = [*tasks, *extract_tasks]
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            unfinished = [book_id for book_id in self.__dispatched if book_id not in self.__finished]
+            for book_id in unfinished:
+                await self.__fail_book(book_id)
+            print(f"REINDEX: stopped at checkpoint {self.__checkpoint}, {len(unfinished)} unfinished books were "
+                  f"queued for indexing")
+            raise
+        self.__report(force=True)
+        if self.__failed:
+            print(f"REINDEX: {len(self.__failed)} failed books were queued for indexing")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Rebuilds the books index from book_table")
+    parser.add_argument("--index", default=elastic_cred.books_index, help="Target index")
+    parser.add_argument("--concurrency", type=int, default=indexing_cred.extraction_workers,
+                        help="Books extracted at once")
+    parser.add_argument("--bulk-concurrency", type=int, default=2, help="Parallel bulk request streams")
+    parser.add_argument("--chunk-size", type=int, default=elastic_cred.bulk_chunk_size,
+                        help="Pages per bulk request")
+    parser.add_argument("--checkpoint", default="./data/reindex_checkpoint.json", help="Checkpoint file")
+    parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint")
+    parser.add_argument("--new-version", action="store_true",
+                        help="Build a new physical index and switch the books alias to it when done")
+    parser.add_argument("--keep-old", action="store_true", help="Keep the previous index after the switch")
+    args = parser.parse_args()
+
+    Indexing.set_extraction_limits(args.concurrency, args.concurrency)
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    index = args.index
+    try:
+        if args.new_version:
+            checkpoint_index = Reindexer.checkpoint_index(args.checkpoint)
+            if args.resume and checkpoint_index is not None and checkpoint_index != elastic_cred.books_index:
+                index = checkpoint_index
+            else:
+                index = await next_books_index_name()
+                ## без обновления поиска и реплик во время загрузки, включаются перед переключением
+                await create_books_index(index, refresh_interval="-1")
+            print(f"REINDEX: building {index}")
+
+        reindexer = Reindexer(index, args.concurrency, args.bulk_concurrency, args.chunk_size, args.checkpoint)
+        if args.resume:
+            print(f"REINDEX: resuming after book {reindexer.load_checkpoint()}")
+        await reindexer.run()
+
+        if args.new_version:
+            await _es.indices.put_settings(index=index, settings={"refresh_interval": None})
+            await _es.indices.refresh(index=index)
+            await swap_books_alias(index, delete_old=not args.keep_old)
+            ## книги, проиндексированные воркерами во время перестроения, попали в старый индекс
+            async with async_session_maker() as session:
+                requeued = await IndexJobsCrud.requeue_completed_since(session, started_at)
+                await session.commit()
+            print(f"REINDEX: {elastic_cred.books_index} now points to {index}, {requeued} books queued again")
+    finally:
+        Indexing.shutdown_extraction_pool()
+        Embedding.shutdown()
+        Storage.shutdown()
+        await close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+"""Throughput of authenticated requests (GET /users/profile) with and without the cached user resolution.
+
+A temporary user is created for the run and deleted afterwards:
+    python -m benchmarks.auth 2000 50
+"""
+import asyncio, sys, time
+import httpx
+from sqlalchemy import insert, delete
+
+from app.crud.users import UsersCrud
+from app.main import app
+from app.models import user_table
+from app.settings import async_session_maker, db_engine
+from app.utils import create_tables
+from app.utils.auth import create_access_token
+
+
+async def run(client: httpx.AsyncClient, requests: int, concurrency: int, user_id: int, cached: bool) -> float:
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            if not cached:
+                UsersCrud.invalidate_cached(user_id)
+            response = await client.get("/users/profile")
+            response.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return requests / (time.perf_counter() - started)
+
+
+async def main(requests: int, concurrency: int):
+    await create_tables()
+    async with async_session_maker() as session:
+        result = await session.execute(insert(user_table).values(
+            email="auth-benchmark@bench.local", name="auth benchmark", password_hash="", privileges="basic"
+        ))
+        user_id = result.inserted_primary_key[0]
+        await session.commit()
+    try:
+        cookies = {"users_access_token": create_access_token({"sub": str(user_id)})}
+        ## ASGI-транспорт без lifespan: Elasticsearch и воркеры индексации не нужны
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench",
+                                     cookies=cookies) as client:
+            await run(client, concurrency, concurrency, user_id, cached=False)
+            uncached = await run(client, requests, concurrency, user_id, cached=False)
+            cached = await run(client, requests, concurrency, user_id, cached=True)
+        print(f"{requests} requests, concurrency {concurrency}")
+        print(f"user from database: {uncached:>10.1f} req/s")
+        print(f"cached user:        {cached:>10.1f} req/s")
+        print(f"cache: {UsersCrud.users_cache_stats()}")
+    finally:
+        async with async_session_maker() as session:
+            await session.execute(delete(user_table).where(user_table.c.id == user_id))
+            await session.commit()
+        await db_engine.dispose()
+
+
+if __name__ == "__main__":
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    asyncio.run(main(*(arguments or [2000, 50])))
@@ -0,0 +1,41 @@
+"""Throughput of the embedding pipeline (chunking and batched CPU encoding) for different batch sizes.
+
+Uses the model from EMBEDDING_MODEL, the database and Elasticsearch are not touched:
+    python -m benchmarks.embedding 1 8 32 64
+"""
+import random, sys, time
+
+from app.crud.embedding import Embedding, chunk_text
+from app.settings.embedding import embedding_cred
+
+PAGES = 200
+WORDS_PER_PAGE = 400
+
+
+def synthetic_pages(count: int) -> list[tuple[int, str]]:
+    generator = random.Random(0)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    return [(page, " ".join(generator.choices(vocabulary, k=WORDS_PER_PAGE))) for page in range(1, count + 1)]
+
+
+def main(batch_sizes: list[int]):
+    pages = synthetic_pages(PAGES)
+    started = time.perf_counter()
+    chunks = [chunk for _, content in pages for chunk in chunk_text(content)]
+    chunking = time.perf_counter() - started
+    started = time.perf_counter()
+    Embedding.get_model()
+    print(f"model {embedding_cred.model}: loaded in {time.perf_counter() - started:.2f}s, "
+          f"{len(pages)} pages -> {len(chunks)} chunks in {chunking * 1000:.1f} ms")
+
+    Embedding.encode(chunks[:max(batch_sizes)], max(batch_sizes))
+    print(f"{'batch':>6} | {'chunks/s':>10} | {'pages/s':>10}")
+    for batch_size in sorted(batch_sizes):
+        started = time.perf_counter()
+        Embedding.encode(chunks, batch_size)
+        elapsed = time.perf_counter() - started
+        print(f"{batch_size:>6} | {len(chunks) / elapsed:>10.1f} | {len(pages) / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [1, 8, embedding_cred.batch_size])
@@ -0,0 +1,70 @@
+"""Latency of the substring (ILIKE) filters of books, authors and users for a growing catalog.
+
+Rows are seeded inside a transaction that is rolled back at the end, so the script can be run against a dev database:
+    python -m benchmarks.filters 10000 100000 1000000
+"""
+import asyncio, statistics, sys, time
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud.authors import AuthorsCrud
+from app.crud.books import BooksCrud
+from app.crud.users import UsersCrud
+from app.settings import db_engine
+from app.utils import create_tables
+
+REPEATS = 20
+
+
+async def seed(session: AsyncSession, start: int, stop: int):
+    await session.execute(text(
+        "INSERT INTO author_table (name) SELECT 'author ' || md5(i::text) FROM generate_series(:start, :stop) i"
+    ), {"start": start, "stop": stop - 1})
+    await session.execute(text(
+        "INSERT INTO book_table (theme_id, title, author, description, pdf_qname, avg_mark, marks_count) "
+        "SELECT 1, left(md5(i::text), 40), (SELECT min(id) FROM author_table), md5((-i)::text) || md5(i::text), "
+        "'bench.pdf', 0, 0 FROM generate_series(:start, :stop) i"
+    ), {"start": start, "stop": stop - 1})
+    await session.execute(text(
+        "INSERT INTO user_table (email, name, privileges) "
+        "SELECT md5(i::text) || '@bench.local', left(md5(i::text), 30), 'basic' FROM generate_series(:start, :stop) i"
+    ), {"start": start, "stop": stop - 1})
+    for table in ("book_table", "author_table", "user_table"):
+        await session.execute(text(f"ANALYZE {table}"))
+
+
+async def measure(call) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        await call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+async def main(sizes: list[int]):
+    await create_tables()
+    filters = {
+        "book title": lambda s: BooksCrud.get_multiple(s, title="a1b2"),
+        "book description": lambda s: BooksCrud.get_multiple(s, description="c3d4"),
+        "author name": lambda s: AuthorsCrud.get_multiple(s, "e5f6"),
+        "user name": lambda s: UsersCrud.get_multiple(s, username="a7b8"),
+    }
+    async with db_engine.connect() as connection:
+        transaction = await connection.begin()
+        session = AsyncSession(bind=connection)
+        try:
+            seeded = 0
+            print(f"{'rows':>10} | " + " | ".join(f"{name:>16}" for name in filters))
+            for size in sorted(sizes):
+                await seed(session, seeded, size)
+                seeded = size
+                medians = [await measure(lambda: call(session)) for call in filters.values()]
+                print(f"{size:>10} | " + " | ".join(f"{median:>13.2f} ms" for median in medians))
+        finally:
+            await transaction.rollback()
+    await db_engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main([int(size) for size in sys.argv[1:]] or [10_000, 100_000, 1_000_000]))
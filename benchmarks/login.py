@@ -0,0 +1,101 @@
+"""Login throughput (POST /users/login) and the longest event loop stall while logins are processed.
+
+The same number of password checks is also run inline on the event loop, as before hashing was moved to
+the thread pool. A temporary user is created for the run and deleted afterwards:
+    python -m benchmarks.login 200 20
+"""
+import asyncio, sys, time
+import httpx
+from sqlalchemy import insert, delete
+
+from app.main import app
+from app.models import user_table
+from app.settings import async_session_maker, db_engine, auth_cred
+from app.utils import create_tables, get_password_hash
+from app.utils.crypt import pwd_context
+
+EMAIL = "login-benchmark@bench.local"
+PASSWORD = "benchmark-password"
+
+
+class LoopLagMonitor:
+    """Longest delay of a periodic callback, i.e. the longest time the loop was blocked"""
+
+    def __init__(self, interval: float = 0.005):
+        self.__interval = interval
+        self.max_lag = 0.0
+        self.__task: asyncio.Task | None = None
+
+    async def __tick(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.__interval)
+            self.max_lag = max(self.max_lag, time.perf_counter() - started - self.__interval)
+
+    def __enter__(self):
+        self.__task = asyncio.create_task(self.__tick())
+        return self
+
+    def __exit__(self, *args):
+        self.__task.cancel()
+
+
+async def inline_checks(password_hash: str, requests: int, concurrency: int) -> tuple[float, float]:
+    async def check():
+        await asyncio.sleep(0)
+        pwd_context.verify(PASSWORD, password_hash)
+
+    started = time.perf_counter()
+    with LoopLagMonitor() as monitor:
+        for start in range(0, requests, concurrency):
+            await asyncio.gather(*[check() for _ in range(min(concurrency, requests - start))])
+    return requests / (time.perf_counter() - started), monitor.max_lag
+
+
+async def logins(client: httpx.AsyncClient, requests: int, concurrency: int) -> tuple[float, float, int]:
+    remaining = iter(range(requests))
+    rejected = 0
+
+    async def worker():
+        nonlocal rejected
+        for _ in remaining:
+            response = await client.post("/users/login", json={"email": EMAIL, "password": PASSWORD})
+            if response.status_code == 503:
+                rejected += 1
+            else:
+                response.raise_for_status()
+
+    started = time.perf_counter()
+    with LoopLagMonitor() as monitor:
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return requests / (time.perf_counter() - started), monitor.max_lag, rejected
+
+
+async def main(requests: int, concurrency: int):
+    await create_tables()
+    password_hash = await get_password_hash(PASSWORD)
+    async with async_session_maker() as session:
+        result = await session.execute(insert(user_table).values(
+            email=EMAIL, name="login benchmark", password_hash=password_hash, privileges="basic"
+        ))
+        user_id = result.inserted_primary_key[0]
+        await session.commit()
+    try:
+        print(f"{requests} logins, concurrency {concurrency}, bcrypt rounds {auth_cred.bcrypt_rounds}, "
+              f"{auth_cred.hashing_workers} hashing threads")
+        throughput, lag = await inline_checks(password_hash, requests, concurrency)
+        print(f"inline on the event loop: {throughput:>8.1f} checks/s, max loop stall {lag * 1000:>8.1f} ms")
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            throughput, lag, rejected = await logins(client, requests, concurrency)
+        print(f"POST /users/login:        {throughput:>8.1f} logins/s, max loop stall {lag * 1000:>8.1f} ms, "
+              f"{rejected} rejected")
+    finally:
+        async with async_session_maker() as session:
+            await session.execute(delete(user_table).where(user_table.c.id == user_id))
+            await session.commit()
+        await db_engine.dispose()
+
+
+if __name__ == "__main__":
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    asyncio.run(main(*(arguments or [200, 20])))